@@ -0,0 +1,5 @@
+""" Benchmarks of filepatch on synthetic diffs.
+
+    python -m benchmarks -o results.json
+    python -m benchmarks --compare old.json new.json
+"""
@@ -0,0 +1,54 @@
+""" usage: python -m benchmarks [-o results.json] [scenario ...]
+           python -m benchmarks --compare old.json new.json
+"""
+import argparse
+import json
+import sys
+
+from benchmarks.suite import SCENARIOS, run, format_results, \
+    format_comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Time filepatch operations on synthetic diffs.")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="scenarios to run, one of %s (all by default)"
+                        % ", ".join(SCENARIOS))
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="save results as JSON")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of timed runs of each operation "
+                        "(default: %(default)s)")
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+                        help="multiply size of generated diffs")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved results and exit")
+    options = parser.parse_args()
+
+    if options.compare:
+        with open(options.compare[0]) as fp:
+            old = json.load(fp)
+        with open(options.compare[1]) as fp:
+            new = json.load(fp)
+        print(format_comparison(old, new))
+        return
+
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %r" % name)
+
+    def progress(name):
+        sys.stderr.write("running %s\n" % name)
+
+    results = run(options.scenarios, options.repeat, options.scale,
+                  progress)
+    print(format_results(results))
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
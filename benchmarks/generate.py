@@ -0,0 +1,73 @@
+""" Generators of synthetic unified diffs together with source files,
+    that the diffs apply to.
+"""
+import random
+
+HEADERS = ("plain", "git", "hg", "svn")
+
+
+def _header(name, header):
+    """ return lines of patch header with filenames for `name` """
+    if header == "git":
+        return (b"diff --git a/%s b/%s\n"
+                b"index 1234567..89abcde 100644\n"
+                b"--- a/%s\n+++ b/%s\n" % (name, name, name, name))
+    if header == "hg":
+        return (b"diff -r 0123456789ab %s\n"
+                b"--- a/%s\n+++ b/%s\n" % (name, name, name))
+    if header == "svn":
+        return (b"Index: %s\n" % name + b"=" * 67 + b"\n"
+                b"--- %s\t(revision 1)\n+++ %s\t(working copy)\n"
+                % (name, name))
+    return b"--- %s\n+++ %s\n" % (name, name)
+
+
+def synthetic_tree(files=100, hunks=4, hunklines=30, filelines=None,
+                   crlf=0.0, header="plain", seed=0):
+    """ return (diff, sources) for `files` files with `hunks` hunks of
+        `hunklines` source lines each, spread evenly over `filelines`
+        lines of source file. Every fifth hunk line is changed and one
+        line is added in the middle of each hunk.
+
+        `crlf` is the fraction of files with CRLF line ends, which are
+        used both in the files and their hunks. `header` is one of
+        "plain", "git", "hg" or "svn" and selects format of patch
+        headers. `sources` maps file names to their content.
+    """
+    if header not in HEADERS:
+        raise ValueError("header must be one of %s" % ", ".join(HEADERS))
+    if filelines is None:
+        filelines = hunks * hunklines * 3
+    gap = filelines // max(hunks, 1)
+    if gap < hunklines:
+        raise ValueError("%d hunks of %d lines don't fit in %d lines"
+                         % (hunks, hunklines, filelines))
+    rnd = random.Random(seed)
+
+    diff = []
+    sources = {}
+    for f in range(files):
+        name = b"dir%d/file%d.c" % (f // 100, f)
+        eol = b"\r\n" if rnd.random() < crlf else b"\n"
+        lines = [b"    source line %d of file %d;%s" % (i, f, eol)
+                 for i in range(filelines)]
+        sources[name] = b"".join(lines)
+
+        diff.append(_header(name, header))
+        for h in range(hunks):
+            start = h * gap
+            # each previous hunk adds one line
+            diff.append(b"@@ -%d,%d +%d,%d @@\n"
+                        % (start + 1, hunklines, start + h + 1,
+                           hunklines + 1))
+            for i in range(hunklines):
+                line = lines[start + i]
+                if i == hunklines // 2:
+                    diff.append(b"+    added line %d of file %d;%s"
+                                % (h, f, eol))
+                if i % 5 == 2:
+                    diff.append(b"-" + line)
+                    diff.append(b"+" + line.replace(b"source", b"changed"))
+                else:
+                    diff.append(b" " + line)
+    return b"".join(diff), sources
@@ -0,0 +1,75 @@
+""" Report memory used by parsed hunks in bytes per diff line, comparing
+    compact HunkText storage with list of bytes lines and Hunk/Patch
+    objects with __dict__ used before.
+
+    usage: python benchmarks/hunk_memory.py [unified.diff]
+"""
+import sys
+import tracemalloc
+from io import BytesIO
+
+from filepatch import PatchSet
+
+
+class LegacyHunk(object):
+    def __init__(self, hunk):
+        self.startsrc = hunk.startsrc
+        self.linessrc = hunk.linessrc
+        self.starttgt = hunk.starttgt
+        self.linestgt = hunk.linestgt
+        self.invalid = hunk.invalid
+        self.desc = hunk.desc
+        self.text = list(hunk.text)
+
+
+class LegacyPatch(object):
+    def __init__(self, patch):
+        self.source = patch.source
+        self.target = patch.target
+        self.hunks = [LegacyHunk(h) for h in patch.hunks]
+        self.hunkends = patch.hunkends
+        self.header = patch.header
+        self.type = patch.type
+
+
+def synthetic_diff(files=200, hunks=5, lines=60):
+    out = []
+    for f in range(files):
+        out.append(b"--- a/file%d.c\n+++ b/file%d.c\n" % (f, f))
+        for h in range(hunks):
+            start = h * 100 + 1
+            out.append(b"@@ -%d,%d +%d,%d @@\n" % (start, lines, start, lines))
+            for i in range(lines):
+                kind = (i % 10 == 3 and b"-") or (i % 10 == 4 and b"+") \
+                    or b" "
+                out.append(kind + b"    source code line %d of hunk %d\n"
+                           % (i, h))
+    return b"".join(out)
+
+
+def measure(build):
+    """ return (result, bytes allocated while building it) """
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as fp:
+            data = fp.read()
+    else:
+        data = synthetic_diff()
+
+    patchset, after = measure(lambda: PatchSet(BytesIO(data)))
+    legacy, before = measure(lambda: [LegacyPatch(p) for p in patchset])
+    lines = sum(len(h.text) for p in patchset for h in p.hunks)
+    print("diff lines: %d" % lines)
+    print("before: %.1f bytes per line" % (float(before) / lines))
+    print("after : %.1f bytes per line" % (float(after) / lines))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+""" Measure import time of filepatch with `python -X importtime` and
+    compare it with the budget documented in README.
+
+    usage: python -m benchmarks.importtime [-n RUNS] [--budget MS] [module]
+
+    Exit status is 1 if the median import time is over the budget.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+#: budget for `import filepatch` in milliseconds, see README
+BUDGET = 25.0
+
+
+def importtime(module="filepatch", runs=7):
+    """ return list of cumulative import times of `module` in ms, each
+        measured in a new interpreter with bytecode already compiled
+    """
+    env = dict(os.environ)
+    # the first run writes bytecode, which is used by the measured runs
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    pattern = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| %s$"
+                         % re.escape(module), re.M)
+    times = []
+    for i in range(runs + 1):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import " + module],
+            stderr=subprocess.PIPE, env=env, universal_newlines=True,
+            check=True)
+        match = pattern.search(proc.stderr)
+        if match is None:
+            raise RuntimeError("import time of %s is not reported" % module)
+        if i:
+            times.append(int(match.group(1)) / 1000.)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.importtime",
+        description="Measure import time and compare it with budget.")
+    parser.add_argument("module", nargs="?", default="filepatch")
+    parser.add_argument("-n", "--runs", type=int, default=7)
+    parser.add_argument("--budget", type=float, default=BUDGET,
+                        help="maximal median in ms (default: %(default)s)")
+    options = parser.parse_args()
+
+    times = importtime(options.module, options.runs)
+    median = statistics.median(times)
+    print("import %s: median %.1f ms, min %.1f ms, budget %.1f ms"
+          % (options.module, median, min(times), options.budget))
+    if median > options.budget:
+        print("over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
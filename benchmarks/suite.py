@@ -0,0 +1,196 @@
+""" Timing of filepatch operations on synthetic diffs.
+
+    For each scenario a diff and its source tree are generated in a
+    temporary directory, and each operation is timed `repeat` times.
+    The best time is reported with throughput in lines and bytes per
+    second of its input, and peak memory traced during an extra run.
+"""
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import filepatch
+from filepatch import fromfile
+
+from benchmarks.generate import synthetic_tree
+
+#: scenario name -> arguments of synthetic_tree()
+SCENARIOS = {
+    "many_files": dict(files=2000, hunks=2, hunklines=20),
+    "huge_hunks": dict(files=4, hunks=2, hunklines=20000),
+    "crlf_mix": dict(files=300, hunks=4, hunklines=30, crlf=0.5),
+    "git": dict(files=500, hunks=4, hunklines=30, header="git"),
+    "hg": dict(files=500, hunks=4, hunklines=30, header="hg"),
+    "svn": dict(files=500, hunks=4, hunklines=30, header="svn"),
+}
+
+OPERATIONS = ("fromfile", "diffstat", "can_patch", "apply", "revert")
+
+
+def _write(root, files):
+    for name, data in files.items():
+        path = os.path.join(root, os.fsdecode(name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(data)
+
+
+def _read(root, names):
+    files = {}
+    for name in names:
+        with open(os.path.join(root, os.fsdecode(name)), "rb") as fp:
+            files[name] = fp.read()
+    return files
+
+
+def _measure(func, repeat, setup=None):
+    """ return (best time, peak traced memory) of `func` calls """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def _can_patch_all(patchset, names):
+    """ return True if all `names` can be patched, checked with
+        can_patch_many() if this version of filepatch has it
+    """
+    many = getattr(patchset, "can_patch_many", None)
+    if many is not None:
+        return all(many(names))
+    return all(patchset.can_patch(name) for name in names)
+
+
+def _check(result, op):
+    if not result:
+        raise RuntimeError("%s failed on generated tree" % op)
+    return result
+
+
+def run_scenario(params, repeat=3, scale=1.0):
+    """ time operations on a tree generated with `params` for
+        synthetic_tree(), where the number of files is multiplied by
+        `scale`. Return dict with sizes of the input and results for
+        each operation.
+    """
+    params = dict(params)
+    params["files"] = max(1, round(params.get("files", 100) * scale))
+    diff, sources = synthetic_tree(**params)
+
+    tmpdir = tempfile.mkdtemp(prefix="filepatch-bench-")
+    prevdir = os.getcwd()
+    try:
+        patchfile = os.path.join(tmpdir, "bench.diff")
+        with open(patchfile, "wb") as fp:
+            fp.write(diff)
+        root = os.path.join(tmpdir, "tree")
+        _write(root, sources)
+
+        patchset = _check(fromfile(patchfile), "fromfile")
+        _check(patchset.apply(root=root), "apply")
+        patched = _read(root, sources)
+        _write(root, sources)
+
+        difflines = diff.count(b"\n")
+        srclines = sum(data.count(b"\n") for data in sources.values())
+        srcbytes = sum(len(data) for data in sources.values())
+        # bytes like patch filenames, which older versions require
+        names = list(sources)
+
+        os.chdir(root)
+        benches = {
+            "fromfile": (lambda: fromfile(patchfile), None,
+                         difflines, len(diff)),
+            "diffstat": (patchset.diffstat, None, difflines, len(diff)),
+            # can_patch() matches hunks against already patched files
+            "can_patch": (lambda: _check(_can_patch_all(patchset, names),
+                                         "can_patch"),
+                          lambda: _write(root, patched), srclines, srcbytes),
+            "apply": (lambda: _check(patchset.apply(), "apply"),
+                      lambda: _write(root, sources), srclines, srcbytes),
+            "revert": (lambda: _check(patchset.revert(), "revert"),
+                       lambda: _write(root, patched), srclines, srcbytes),
+        }
+        results = {}
+        for op in OPERATIONS:
+            func, setup, lines, nbytes = benches[op]
+            seconds, peak = _measure(func, repeat, setup)
+            results[op] = dict(seconds=seconds,
+                               lines_per_sec=lines / seconds,
+                               bytes_per_sec=nbytes / seconds,
+                               peak_memory=peak)
+    finally:
+        os.chdir(prevdir)
+        shutil.rmtree(tmpdir)
+    return dict(params=params, diff_lines=difflines, diff_bytes=len(diff),
+                source_lines=srclines, source_bytes=srcbytes,
+                operations=results)
+
+
+def run(scenarios=None, repeat=3, scale=1.0, progress=None):
+    """ run `scenarios` (all by default), return results as dict ready
+        to be saved as JSON. `progress` is called with each scenario
+        name before it is run.
+    """
+    results = {}
+    for name in scenarios or SCENARIOS:
+        if progress:
+            progress(name)
+        results[name] = run_scenario(SCENARIOS[name], repeat, scale)
+    return dict(version=getattr(filepatch, "__version__", None),
+                python=sys.version.split()[0],
+                platform=platform.platform(),
+                repeat=repeat, scale=scale,
+                scenarios=results)
+
+
+def format_results(results):
+    """ return text table of `results` returned by run() """
+    out = ["%-12s %-10s %10s %14s %14s %12s"
+           % ("scenario", "operation", "seconds", "lines/s", "bytes/s",
+              "peak KiB")]
+    for name, scenario in results["scenarios"].items():
+        for op, res in scenario["operations"].items():
+            out.append("%-12s %-10s %10.4f %14.0f %14.0f %12.0f"
+                       % (name, op, res["seconds"], res["lines_per_sec"],
+                          res["bytes_per_sec"], res["peak_memory"] / 1024.))
+    return "\n".join(out)
+
+
+def format_comparison(old, new):
+    """ return text table comparing results of two runs, with ratios
+        of old time to new time (above 1 is faster) and of peak memory.
+        Scenarios generated with different parameters are skipped.
+    """
+    out = ["%-12s %-10s %10s %10s %8s %8s"
+           % ("scenario", "operation", "old s", "new s", "speedup",
+              "memory")]
+    for name, scenario in new["scenarios"].items():
+        oldscenario = old["scenarios"].get(name)
+        if oldscenario is None or oldscenario["params"] != scenario["params"]:
+            continue
+        for op, res in scenario["operations"].items():
+            oldres = oldscenario["operations"].get(op)
+            if oldres is None:
+                continue
+            out.append("%-12s %-10s %10.4f %10.4f %7.2fx %7.2fx"
+                       % (name, op, oldres["seconds"], res["seconds"],
+                          oldres["seconds"] / res["seconds"],
+                          res["peak_memory"] / max(oldres["peak_memory"], 1)))
+    return "\n".join(out)
@@ -1,53 +1,188 @@
 from __future__ import print_function
 
-from pkg_resources import get_distribution, DistributionNotFound
-
 from io import BytesIO
-from urllib import request
 
 import logging
+import mmap
 
 from filepatch.patchset import PatchSet
 
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:
-    # package is not installed
-    pass
-
 logger = logging.getLogger('filepatch')
 logger.addHandler(logging.NullHandler())
 
 
-def fromurl(url):
+def __getattr__(name):
+    """ Load __version__ and PatchCache on first access. Package
+        metadata and cache dependencies are slow to import and
+        are not needed for parsing and applying patches, see
+        "Import time" in README.
+    """
+    if name == "__version__":
+        try:
+            from importlib.metadata import version, PackageNotFoundError
+        except ImportError:  # Python 3.7
+            from pkg_resources import get_distribution
+            from pkg_resources import DistributionNotFound \
+                as PackageNotFoundError
+
+            def version(name):
+                return get_distribution(name).version
+        try:
+            value = version(__name__)
+        except PackageNotFoundError:
+            # package is not installed
+            raise AttributeError(name)
+    elif name == "PatchCache":
+        from filepatch.cache import PatchCache as value
+    else:
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def fromurl(url, cache=None):
     """ Parse patch from an URL, return False
         if an error occured. Note that this also
         can throw urlopen() exceptions.
+
+        With PatchCache `cache` the patch is downloaded first, and
+        is parsed only if it is not in the cache.
     """
+    from urllib import request
+    if cache is not None:
+        return fromstring(request.urlopen(url).read(), cache)
     ps = PatchSet(request.urlopen(url))
     if ps.errors == 0:
         return ps
     return False
 
 
-def fromfile(filename):
+def fromurls(urls, max_workers=None, cache=None):
+    """ Parse patches from many URLs, return list with result
+        of each URL in the same order. The result is PatchSet,
+        False if the patch has errors, or the exception raised
+        for the URL like urllib URLError or HTTPError.
+
+        Up to `max_workers` patches are downloaded and parsed
+        concurrently (ThreadPoolExecutor default if None), and
+        keep-alive connections to the same host are reused.
+        PatchCache `cache` is used like in fromurl().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from filepatch.fetch import ConnectionPool
+
+    def load(url):
+        try:
+            with pool.urlopen(url) as response:
+                if cache is not None:
+                    return fromstring(response.read(), cache)
+                ps = PatchSet(response)
+        except Exception as e:
+            logger.debug("failed to fetch %s - %s" % (url, e))
+            return e
+        if ps.errors == 0:
+            return ps
+        return False
+
+    with ConnectionPool() as pool:
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(load, urls))
+
+
+async def fromurl_async(url, cache=None):
+    """ Asynchronous fromurl(). Patch is parsed while it is
+        being downloaded, so many patches can be fetched
+        concurrently in one event loop, e.g. with
+        asyncio.gather(). Raises urllib URLError or HTTPError
+        if the download fails.
+
+        With PatchCache `cache` the patch is downloaded first
+        like in fromurl().
+    """
+    from filepatch.fetch import iterurl
+    if cache is not None:
+        data = b"".join([chunk async for chunk in iterurl(url)])
+        return fromstring(data, cache)
+    ps = PatchSet()
+    await ps.aparse(iterurl(url))
+    if ps.errors == 0:
+        return ps
+    return False
+
+
+def fromfile(filename, mapped=False, cache=None, statsonly=False,
+             lazy=False):
     """ Parse patch file. If successful, returns
         PatchSet() object. Otherwise returns False.
+
+        With `mapped` set the file is memory-mapped and hunk
+        lines are read from the mapping only when accessed.
+
+        With PatchCache `cache` parsed patch is loaded from
+        the cache if file content is the same, and is stored
+        there otherwise.
+
+        With `statsonly` hunks are only counted for diffstat,
+        see PatchSet.parse(). Such patches are not stored in
+        the cache.
+
+        With `lazy` the file is memory-mapped and hunk bodies
+        are skipped until they are accessed, see PatchSet.parse().
+        Lazy patches are not stored in the cache either, as that
+        would read all hunks.
     """
+    if cache is not None:
+        key = cache.filekey(filename)
+        patchset = cache.get(key)
+        if patchset is None:
+            patchset = fromfile(filename, mapped, statsonly=statsonly,
+                                lazy=lazy)
+            if patchset is False:
+                return False
+            if not statsonly and not lazy:
+                cache.put(key, patchset)
+        return patchset
+
     patchset = PatchSet()
     logger.debug("reading %s" % filename)
     fp = open(filename, "rb")
-    res = patchset.parse(fp)
-    fp.close()
+    mapping = None
+    if mapped or lazy:
+        try:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty files and special files can not be mapped
+            logger.debug("can not map %s, reading it instead" % filename)
+    if mapping is not None:
+        # mapping holds its own file handle and stays open
+        # while hunks are referencing it
+        fp.close()
+        res = patchset.parse(mapping, statsonly, lazy)
+    else:
+        res = patchset.parse(fp, statsonly)
+        fp.close()
     if res is True:
         return patchset
     return False
 
 
-def fromstring(s):
+def fromstring(s, cache=None):
     """ Parse text string and return PatchSet()
         object (or False if parsing fails)
+
+        PatchCache `cache` is used like in fromfile()
     """
+    if cache is not None:
+        key = cache.key(s)
+        ps = cache.get(key)
+        if ps is None:
+            ps = fromstring(s)
+            if ps is False:
+                return False
+            cache.put(key, ps)
+        return ps
+
     ps = PatchSet(BytesIO(s))
     if ps.errors == 0:
         return ps
@@ -1,7 +1,7 @@
 import logging
 from os.path import isfile
 
-from filepatch import __version__, PatchSet, fromurl, fromfile
+from filepatch import PatchSet, fromurl, fromfile
 
 
 def main():
@@ -9,10 +9,17 @@ def main():
     from os.path import exists
     import sys
 
-    opt = OptionParser(usage="1. %prog [options] unified.diff\n"
-                             "       2. %prog [options] http://host/patch\n"
-                             "       3. %prog [options] -- < unified.diff",
-                       version="python-patch %s" % __version__)
+    class VersionParser(OptionParser):
+        # package metadata is slow to load, so version is looked up
+        # only when it is printed
+        def get_version(self):
+            import filepatch
+            return self.version % filepatch.__version__
+
+    opt = VersionParser(usage="1. %prog [options] unified.diff\n"
+                              "       2. %prog [options] http://host/patch\n"
+                              "       3. %prog [options] -- < unified.diff",
+                        version="python-patch %s")
     opt.add_option("-q", "--quiet", action="store_const", dest="verbosity",
                    const=0, help="print only warnings and errors", default=1)
     opt.add_option("-v", "--verbose", action="count", dest="verbosity",
@@ -23,6 +30,14 @@ def main():
                    help="specify root directory for applying patch")
     opt.add_option("-p", "--strip", type="int", metavar='N', default=0,
                    help="strip N path components from filenames")
+    opt.add_option("-F", "--fuzz", type="int", metavar='N',
+                   help="apply hunks at an offset from their lines, "
+                        "ignoring up to N lines of context")
+    opt.add_option("--newline", type="choice", default="auto",
+                   choices=["auto", "lf", "crlf", "preserve"],
+                   help="line ends of added lines: auto (default) uses "
+                        "line ends of patched file, preserve keeps them "
+                        "from the patch")
     opt.add_option("--revert", action="store_true",
                    help="apply patch in reverse order (unpatch)")
     (options, args) = opt.parse_args()
@@ -35,8 +50,10 @@ def main():
 
     setup_logging(options.verbosity)
 
+    # diffstat only needs line counts, so hunks are not kept
     if readstdin:
-        patch = PatchSet(sys.stdin)
+        patch = PatchSet()
+        patch.parse(sys.stdin.buffer, statsonly=options.diffstat)
     else:
         patchfile = args[0]
         urltest = patchfile.split(':')[0]
@@ -46,16 +63,21 @@ def main():
         else:
             if not exists(patchfile) or not isfile(patchfile):
                 sys.exit("patch file does not exist - %s" % patchfile)
-            patch = fromfile(patchfile)
+            patch = fromfile(patchfile, mapped=True,
+                             statsonly=options.diffstat)
 
     if options.diffstat:
         print(patch.diffstat())
         sys.exit(0)
 
     if options.revert:
-        patch.revert(options.strip, root=options.directory) or sys.exit(-1)
+        patch.revert(options.strip, root=options.directory,
+                     fuzz=options.fuzz, newline=options.newline) \
+            or sys.exit(-1)
     else:
-        patch.apply(options.strip, root=options.directory) or sys.exit(-1)
+        patch.apply(options.strip, root=options.directory,
+                    fuzz=options.fuzz, newline=options.newline) \
+            or sys.exit(-1)
 
     # todo: document and test line ends handling logic - patch.py detects
     # proper line-endings for inserted hunks and issues a warning if patched
@@ -0,0 +1,119 @@
+class BlockReader(object):
+    """ Buffered reader of binary stream, which returns either single
+        lines or blocks of whole lines, counting lines and line ends on
+        the way. Unchanged parts of file are copied as blocks without
+        splitting them into lines.
+    """
+
+    def __init__(self, stream, blocksize=1 << 16):
+        self.stream = stream
+        self.blocksize = blocksize
+        self.buf = b''
+        self.pos = 0
+        #: number of lines read
+        self.lineno = 0
+        #: number of lines that end with LF, CRLF and CR
+        self.lf = 0
+        self.crlf = 0
+        self.cr = 0
+
+    def _fill(self):
+        """ read next block into buffer, keeping unread data
+            return False at the end of stream
+        """
+        data = self.stream.read(self.blocksize)
+        if not data:
+            return False
+        if self.pos < len(self.buf):
+            self.buf = self.buf[self.pos:] + data
+        else:
+            self.buf = data
+        self.pos = 0
+        return True
+
+    def _last(self):
+        """ return unread data at the end of stream as the last line """
+        line = self.buf[self.pos:]
+        self.pos = len(self.buf)
+        if line:
+            self.lineno += 1
+            if line.endswith(b"\r"):
+                self.cr += 1
+        return line
+
+    def readline(self):
+        """ return next line, or empty string at the end of stream """
+        end = self.buf.find(b"\n", self.pos)
+        while end < 0:
+            searched = len(self.buf) - self.pos
+            if not self._fill():
+                return self._last()
+            end = self.buf.find(b"\n", searched)
+        line = self.buf[self.pos:end+1]
+        self.pos = end + 1
+        self.lineno += 1
+        if line.endswith(b"\r\n"):
+            self.crlf += 1
+        else:
+            self.lf += 1
+        return line
+
+    def lines(self, count):
+        """ Generator that yields blocks of the next `count` lines, or
+            less at the end of stream
+        """
+        while count > 0:
+            buf, pos = self.buf, self.pos
+            found = buf.count(b"\n", pos)
+            if not found:
+                if not self._fill():
+                    line = self._last()
+                    if line:
+                        yield line
+                    return
+                continue
+            if found <= count:
+                end = buf.rfind(b"\n") + 1
+            else:
+                found = count
+                end = pos
+                for i in range(count):
+                    end = buf.index(b"\n", end) + 1
+            crlf = buf.count(b"\r\n", pos, end)
+            self.crlf += crlf
+            self.lf += found - crlf
+            self.lineno += found
+            self.pos = end
+            count -= found
+            yield buf[pos:end]
+
+    def rest(self):
+        """ Generator that yields blocks up to the end of stream """
+        if self.pos < len(self.buf):
+            yield self.buf[self.pos:]
+        self.buf = b''
+        self.pos = 0
+        while True:
+            data = self.stream.read(1 << 20)
+            if not data:
+                break
+            yield data
+
+    def copy_rest(self, outstream):
+        """ write data up to the end of stream to `outstream` """
+        if self.pos < len(self.buf):
+            outstream.write(self.buf[self.pos:])
+        self.buf = b''
+        self.pos = 0
+        import shutil
+        shutil.copyfileobj(self.stream, outstream, 1 << 20)
+
+    def newline(self):
+        """ return line end used by all lines read so far, or None if
+            they are mixed or no lines are read
+        """
+        if bool(self.lf) + bool(self.crlf) + bool(self.cr) != 1:
+            return None
+        if self.lf:
+            return b"\n"
+        return b"\r\n" if self.crlf else b"\r"
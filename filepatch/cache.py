@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+from filepatch.patchset import PatchSet
+
+logger = logging.getLogger('filepatch')
+debug = logger.debug
+
+
+class PatchCache(object):
+    """ On-disk cache of parsed patches, keyed by SHA-256 hash of patch
+        content. When total size of entries in `directory` exceeds
+        `maxsize` bytes, least recently used entries are removed.
+
+        The cache is used by fromfile(), fromstring() and fromurl() when
+        it is passed in their `cache` argument. Entries are written with
+        PatchSet.dump() and are memory-mapped when loaded.
+    """
+
+    def __init__(self, directory, maxsize=256 * 1024 * 1024):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(data):
+        """ return cache key for patch content `data` """
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def filekey(filename):
+        """ return cache key for content of patch file `filename` """
+        digest = hashlib.sha256()
+        with open(filename, "rb") as fp:
+            for block in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".patchset")
+
+    def get(self, key):
+        """ return cached PatchSet for `key` or None. Entries that fail
+            to load, including those with wrong checksum, are removed.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fp:
+                patchset = PatchSet.load(fp, verify=True)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            debug("removing broken cache entry %s - %s" % (path, e))
+            self.discard(key)
+            return None
+        try:
+            # modification time orders entries by last use
+            os.utime(path)
+        except OSError:
+            pass
+        debug("loaded parsed patch from cache %s" % path)
+        return patchset
+
+    def put(self, key, patchset):
+        """ store `patchset` for `key`, removing least recently used
+            entries if the cache is full
+        """
+        fd, tmpname = tempfile.mkstemp(prefix=key + ".",
+                                       dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                patchset.dump(fp)
+            os.replace(tmpname, self._path(key))
+        except Exception:
+            os.unlink(tmpname)
+            raise
+        self._evict()
+
+    def discard(self, key):
+        """ remove entry for `key` if it exists """
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """ remove all entries """
+        for key in self.keys():
+            self.discard(key)
+
+    def keys(self):
+        """ return list of keys of cached entries """
+        return [name[:-len(".patchset")]
+                for name in os.listdir(self.directory)
+                if name.endswith(".patchset")]
+
+    def _evict(self):
+        """ remove least recently used entries until the cache fits """
+        entries = []
+        total = 0
+        for key in self.keys():
+            try:
+                st = os.stat(self._path(key))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, key))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, key in entries:
+            if total <= self.maxsize:
+                break
+            debug("removing least recently used cache entry %s" % key)
+            self.discard(key)
+            total -= size
@@ -0,0 +1,246 @@
+""" Downloading of patches for fromurl_async() and fromurls().
+
+    iterurl() is a minimal HTTP/1.1 client on top of asyncio streams,
+    which yields the response body in chunks as they arrive, so that
+    they can be parsed while the download is still in progress.
+
+    ConnectionPool keeps http.client connections open between requests
+    to the same host, so that a series of patches is fetched over few
+    keep-alive connections.
+"""
+
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from http.client import (HTTPConnection, HTTPSConnection, IncompleteRead,
+                         RemoteDisconnected, parse_headers)
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+
+logger = logging.getLogger('filepatch')
+debug = logger.debug
+
+#: status codes with Location header to follow
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+CHUNKSIZE = 1 << 16
+
+
+async def _open(url):
+    """ send GET request for `url`, return (reader, writer, status,
+        reason, headers) of the response
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise URLError("unsupported URL scheme %r" % parts.scheme)
+    if not parts.hostname:
+        raise URLError("no host given in %r" % url)
+    https = parts.scheme == "https"
+    port = parts.port or (443 if https else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    host = parts.hostname
+    if parts.port:
+        host += ":%d" % parts.port
+
+    try:
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, port, ssl=https or None)
+    except OSError as e:
+        raise URLError(e)
+    try:
+        writer.write(("GET %s HTTP/1.1\r\n"
+                      "Host: %s\r\n"
+                      "User-Agent: filepatch\r\n"
+                      "Connection: close\r\n\r\n" % (path, host))
+                     .encode("ascii"))
+        await writer.drain()
+        statusline = await reader.readline()
+        try:
+            version, status, reason = (statusline.decode("iso-8859-1")
+                                       .rstrip("\r\n").split(" ", 2))
+            status = int(status)
+        except ValueError:
+            raise URLError("bad HTTP status line %r from %s"
+                           % (statusline, url))
+        head = []
+        while True:
+            line = await reader.readline()
+            head.append(line)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        headers = parse_headers(BytesIO(b"".join(head)))
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer, status, reason, headers
+
+
+async def _body(reader, headers):
+    """ yield chunks of response body from `reader` """
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        while True:
+            line = await reader.readline()
+            try:
+                size = int(line.split(b";", 1)[0], 16)
+            except ValueError:
+                raise IncompleteRead(line)
+            if size == 0:
+                # skip trailer
+                while await reader.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            try:
+                yield await reader.readexactly(size)
+            except asyncio.IncompleteReadError as e:
+                raise IncompleteRead(e.partial, e.expected)
+            await reader.readline()
+    elif headers.get("Content-Length") is not None:
+        remaining = int(headers["Content-Length"])
+        while remaining > 0:
+            chunk = await reader.read(min(remaining, CHUNKSIZE))
+            if not chunk:
+                raise IncompleteRead(b"", remaining)
+            remaining -= len(chunk)
+            yield chunk
+    else:
+        # body ends when connection is closed
+        while True:
+            chunk = await reader.read(CHUNKSIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def iterurl(url):
+    """ asynchronous generator of chunks of the body of `url`, follows
+        redirects and raises urllib HTTPError for unsuccessful responses
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        debug("fetching %s" % url)
+        reader, writer, status, reason, headers = await _open(url)
+        try:
+            location = headers.get("Location")
+            if status in REDIRECTS and location:
+                url = urljoin(url, location)
+                continue
+            if not 200 <= status < 300:
+                raise HTTPError(url, status, reason, headers, None)
+            async for chunk in _body(reader, headers):
+                yield chunk
+            return
+        finally:
+            writer.close()
+    raise HTTPError(url, status, "too many redirects", headers, None)
+
+
+class ConnectionPool(object):
+    """ Thread-safe pool of idle keep-alive HTTP connections, keyed by
+        scheme, host and port. Connections are created when no idle one
+        is available, so the number of connections is bounded by the
+        number of threads using the pool.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ close all idle connections """
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _acquire(self, key):
+        """ return (connection, reused) for `key` """
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            return HTTPSConnection(host, port), False
+        return HTTPConnection(host, port), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _request(self, url):
+        """ send GET request for `url`, return (key, connection,
+            response). A reused connection, which was closed by the
+            server in the meantime, is replaced by a new one.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise URLError("unsupported URL scheme %r" % parts.scheme)
+        if not parts.hostname:
+            raise URLError("no host given in %r" % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request("GET", path,
+                             headers={"User-Agent": "filepatch"})
+                return key, conn, conn.getresponse()
+            except (RemoteDisconnected, ConnectionError) as e:
+                conn.close()
+                if not reused:
+                    raise URLError(e)
+                debug("reconnecting to %s" % parts.netloc)
+            except OSError as e:
+                conn.close()
+                raise URLError(e)
+            except BaseException:
+                conn.close()
+                raise
+
+    @contextmanager
+    def urlopen(self, url):
+        """ context manager with http.client.HTTPResponse for `url`.
+            Follows redirects and raises urllib HTTPError for
+            unsuccessful responses. When the body is read completely,
+            the connection is returned to the pool.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            debug("fetching %s" % url)
+            key, conn, resp = self._request(url)
+            try:
+                location = resp.getheader("Location")
+                if resp.status in REDIRECTS and location:
+                    resp.read()
+                    url = urljoin(url, location)
+                elif not 200 <= resp.status < 300:
+                    resp.read()
+                    raise HTTPError(url, resp.status, resp.reason,
+                                    resp.headers, None)
+                else:
+                    yield resp
+                    return
+            finally:
+                # length is 0 when body was read by lines to the end, but
+                # the response is not closed yet, which is required
+                # before the next request
+                done = resp.isclosed() or resp.length == 0
+                if done and not resp.will_close:
+                    resp.close()
+                    self._release(key, conn)
+                else:
+                    conn.close()
+        raise HTTPError(url, resp.status, "too many redirects",
+                        resp.headers, None)
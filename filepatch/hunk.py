@@ -1,5 +1,166 @@
+from array import array
+from collections.abc import Sequence
+from itertools import accumulate, compress
+from operator import sub
+
+# hunk line types, selected by the first byte of a line
+CONTEXT = 0
+INSERT = 1
+DELETE = 2
+MARKER = 3   # "\ No newline at end of file"
+BLANK = 4    # empty line that lost its leading space
+INVALID = 5
+
+#: lookup table from the first byte of a hunk line to its type
+LINE_TYPES = bytearray([INVALID]) * 256
+LINE_TYPES[ord(" ")] = CONTEXT
+LINE_TYPES[ord("+")] = INSERT
+LINE_TYPES[ord("-")] = DELETE
+LINE_TYPES[ord("\\")] = MARKER
+LINE_TYPES[ord("\r")] = BLANK
+LINE_TYPES[ord("\n")] = BLANK
+LINE_TYPES = bytes(LINE_TYPES)
+
+#: the same table for reversed hunks, where insertions are deletions
+REVERSED_LINE_TYPES = LINE_TYPES.translate(
+    bytes([CONTEXT, DELETE, INSERT, MARKER, BLANK, INVALID]).ljust(256))
+
+#: number of source and target lines taken by each line type
+SRC_LINES = (1, 0, 1, 0)
+TGT_LINES = (1, 1, 0, 0)
+
+
+class HunkText(Sequence):
+    """ Read-only list of hunk lines, stored compactly as one contiguous
+        buffer with an array of line offsets and a string of line types.
+        `bytes` object for a line is created only when it is accessed.
+
+        The buffer is either owned (joined from `lines`) or is an external
+        `data` buffer like mmap of the patch file, where `lines` start at
+        `base` offset.
+    """
+    __slots__ = ('data', 'base', 'offsets', 'ops')
+
+    def __init__(self, lines=(), data=None, base=0):
+        if data is None:
+            data = b''.join(lines)
+            base = 0
+        self.data = data
+        self.base = base
+        #: line i spans from base+offsets[i] to base+offsets[i+1]
+        self.offsets = array('I', [0])
+        self.offsets.extend(accumulate(map(len, lines)))
+        #: line types, one byte per line
+        self.ops = b''.join([line[:1] for line in lines]).translate(
+            LINE_TYPES)
+
+    @classmethod
+    def fromparts(cls, data, offsets, ops, base=0):
+        """ create HunkText from `data` buffer, `offsets` array and `ops`
+            line types, as they are stored in HunkText attributes
+        """
+        text = cls.__new__(cls)
+        text.data = data
+        text.base = base
+        text.offsets = offsets
+        text.ops = ops
+        return text
+
+    def __len__(self):
+        return len(self.ops)
+
+    def stats(self):
+        """ return (inserted lines, deleted lines, size change in bytes)
+            counted like in PatchSet.diffstat()
+        """
+        ops = bytes(self.ops)
+        offsets = self.offsets
+        sizes = list(map(sub, offsets[1:], offsets))
+        inserts = ops.count(INSERT)
+        deletes = ops.count(DELETE)
+        # line sizes include the leading + or -
+        delta = (sum(compress(sizes, map(INSERT.__eq__, ops))) - inserts -
+                 sum(compress(sizes, map(DELETE.__eq__, ops))) + deletes)
+        return inserts, deletes, delta
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("hunk line index out of range")
+        base = self.base
+        line = self.data[base+self.offsets[idx]:base+self.offsets[idx+1]]
+        if self.ops[idx] == BLANK:
+            # restore leading space of empty context line
+            return b' ' + line
+        return line
+
+    def __iter__(self):
+        data = self.data
+        base = self.base
+        start = base
+        for op, end in zip(self.ops, self.offsets[1:]):
+            end += base
+            if op == BLANK:
+                yield b' ' + data[start:end]
+            else:
+                yield data[start:end]
+            start = end
+
+    def __eq__(self, other):
+        if isinstance(other, (list, HunkText)):
+            return len(self) == len(other) and all(
+                a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    # text is immutable and may reference mmap, which can not be copied
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (HunkText, (list(self),))
+
+
+class LazyText(object):
+    """ Position of well-formed hunk lines in `data` buffer like mmap of
+        the patch file. Hunk.text is replaced with HunkText of the lines
+        when it is accessed for the first time.
+    """
+    __slots__ = ('data', 'start', 'end')
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def load(self):
+        """ return HunkText of the lines, which references `data` """
+        lines = self.data[self.start:self.end].split(b"\n")
+        # the last line end is followed by an empty string
+        lines.pop()
+        return HunkText([line + b"\n" for line in lines],
+                        self.data, self.start)
+
+    # mmap can not be copied, copies get the lines
+    def __deepcopy__(self, memo):
+        return HunkText(list(self.load()))
+
+    def __reduce__(self):
+        return (HunkText, (list(self.load()),))
+
+
 class Hunk(object):
     """ Parsed hunk data container (hunk starts with @@ -R +R @@) """
+    __slots__ = ('startsrc', 'linessrc', 'starttgt', 'linestgt', 'invalid',
+                 'desc', '_text', '_lines')
 
     def __init__(self):
         self.startsrc = None  #: line count starts with 1
@@ -9,3 +170,61 @@ class Hunk(object):
         self.invalid = False
         self.desc = ''
         self.text = []
+
+    @property
+    def text(self):
+        """ hunk lines with their type prefixes """
+        text = self._text
+        if text.__class__ is LazyText:
+            text = self._text = text.load()
+        return text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+        self._lines = None
+
+    def _split(self):
+        """ return cached (source lines, target lines), computing them on
+            first use
+        """
+        if self._lines is None:
+            source = []
+            target = []
+            for line in self.text:
+                kind = LINE_TYPES[line[0]]
+                if kind == MARKER:
+                    continue
+                line = line[1:].rstrip(b"\r\n")
+                if kind != INSERT:
+                    source.append(line)
+                if kind != DELETE:
+                    target.append(line)
+            self._lines = (tuple(source), tuple(target))
+        return self._lines
+
+    # lines are cached until text is replaced, changing lines of `text`
+    # list in place requires assigning it again
+
+    @property
+    def source_lines(self):
+        """ tuple of source lines without line ends """
+        return self._split()[0]
+
+    @property
+    def target_lines(self):
+        """ tuple of target lines without line ends """
+        return self._split()[1]
+
+    # hashes are computed when asked for, they differ between processes
+    # like hashes of bytes
+
+    @property
+    def source_hash(self):
+        """ hash of source_lines """
+        return hash(self._split()[0])
+
+    @property
+    def target_hash(self):
+        """ hash of target_lines """
+        return hash(self._split()[1])
@@ -0,0 +1,58 @@
+from bisect import bisect_left
+
+
+class LineIndex(object):
+    """ Index of file lines by content, used to find hunk lines in file
+        when they are not at the position from hunk header.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        #: line -> sorted list of its positions
+        self.positions = {}
+        for pos, line in enumerate(lines):
+            self.positions.setdefault(line, []).append(pos)
+
+    def find(self, pattern, expected, start=0):
+        """ return position of `pattern` list of lines that is the
+            nearest to `expected`, but not before `start`, or None
+        """
+        lines = self.lines
+        size = len(pattern)
+        if not size:
+            return min(max(expected, start), len(lines))
+
+        # the rarest line of pattern gives the least candidates to check
+        anchor = 0
+        positions = None
+        for k, line in enumerate(pattern):
+            found = self.positions.get(line, ())
+            if positions is None or len(found) < len(positions):
+                anchor, positions = k, found
+                if len(found) < 2:
+                    break
+        if not positions:
+            return None
+
+        # check candidates starting with the nearest to expected position
+        right = bisect_left(positions, expected + anchor)
+        left = right - 1
+        while left >= 0 or right < len(positions):
+            if right >= len(positions) or left >= 0 and \
+                    expected + anchor - positions[left] <= \
+                    positions[right] - expected - anchor:
+                begin = positions[left] - anchor
+                left -= 1
+                if begin < start:
+                    # all other candidates on the left are before start
+                    left = -1
+                    continue
+            else:
+                begin = positions[right] - anchor
+                right += 1
+                if begin < start:
+                    continue
+            if begin + size <= len(lines) and \
+                    lines[begin:begin+size] == pattern:
+                return begin
+        return None
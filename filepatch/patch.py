@@ -1,8 +1,16 @@
+import weakref
+
+
 class Patch(object):
     """ Patch for a single file.
         If used as an iterable, returns hunks.
     """
+    __slots__ = ('_source', '_target', 'hunks', 'hunkends', 'header',
+                 'type', 'inserts', 'deletes', 'delta', '_owners')
+
     def __init__(self):
+        # weak set of PatchSets that index filenames of this patch
+        self._owners = None
         self.source = None
         self.target = None
         self.hunks = []
@@ -10,3 +18,47 @@ class Patch(object):
         self.header = []
 
         self.type = None
+
+        # numbers of inserted and deleted lines and size change in bytes,
+        # counted by parser, None if they are not known
+        self.inserts = None
+        self.deletes = None
+        self.delta = None
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name != '_owners' and hasattr(self, name))
+
+    def __setstate__(self, state):
+        self._owners = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def _watch(self, patchset):
+        """ report renames of this patch to `patchset` """
+        if self._owners is None:
+            self._owners = weakref.WeakSet()
+        self._owners.add(patchset)
+
+    def _renamed(self):
+        if self._owners:
+            for owner in list(self._owners):
+                owner._changed()
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, source):
+        self._source = source
+        self._renamed()
+
+    @property
+    def target(self):
+        return self._target
+
+    @target.setter
+    def target(self, target):
+        self._target = target
+        self._renamed()
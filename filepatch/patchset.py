@@ -1,22 +1,40 @@
-import copy
 import logging
+import mmap
 import re
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from contextlib import contextmanager
 from enum import Enum
+from itertools import count, islice
 
-from os.path import exists, isfile, abspath
+from os.path import exists, isfile, abspath, basename, dirname
 import os
-import shutil
 
-from filepatch.hunk import Hunk
+from filepatch.blockreader import BlockReader
+from filepatch.lineindex import LineIndex
+from filepatch.hunk import (Hunk, HunkText, LazyText, LINE_TYPES,
+                            REVERSED_LINE_TYPES,
+                            SRC_LINES, TGT_LINES, CONTEXT, INSERT, DELETE,
+                            MARKER, BLANK, INVALID)
 from filepatch.patch import Patch
 from filepatch.utils import pathstrip, xnormpath, xisabs, xstrip
-from filepatch.wrap_enumerate import WrapEnumerate
+from filepatch.wrap_enumerate import LineFeed, MappedLines, WrapEnumerate
 
 HUNKHEAD_REGEX = re.compile(
     b"^@@ -(\\d+)(,(\\d+))? \\+(\\d+)(,(\\d+))? @@(.*)")
 # regexp to match start of hunk, used groups - 1,3,4,6
 HUNK_REGEX = re.compile(
     b"^@@ -(\\d+)(,(\\d+))? \\+(\\d+)(,(\\d+))? @@")
+NEWLINE_REGEX = re.compile(b"\n")
+
+#: line ends of added lines for `newline` option of apply(). None means
+#: that line ends are detected from patched file ("auto") or are kept
+#: as they are in the patch ("preserve")
+NEWLINES = {"auto": None, "preserve": None, "lf": b"\n", "crlf": b"\r\n"}
+
+#: source of PatchSet versions, next() is atomic unlike `+= 1`
+_versions = count(1)
 
 logger = logging.getLogger('filepatch')
 debug = logger.debug
@@ -24,6 +42,102 @@ info = logger.info
 warning = logger.warning
 
 
+class _LogCapture(logging.Filter):
+    """ Holds back log records of threads that have a list of records set,
+        so that messages of files patched in parallel are emitted in order
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self.local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+_log_capture = _LogCapture()
+logger.addFilter(_log_capture)
+
+
+def _skip_hunk(data, pos, linessrc, linestgt):
+    """ find the end of hunk body starting at `pos` of `data` buffer,
+        which follows a line end, by counting line types in blocks of
+        lines instead of reading them one by one. Return (end, number of
+        lines, LF line ends, CRLF line ends), or None if the body is not
+        well-formed and must be read by the parser, which reports errors
+    """
+    if not linessrc and not linestgt:
+        # the parser reports such hunk as invalid
+        return None
+    srcneed = linessrc
+    tgtneed = linestgt
+    lines = crlf = 0
+    while srcneed > 0 or tgtneed > 0:
+        # a valid hunk has at least this number of lines left
+        need = max(srcneed, tgtneed)
+        match = next(islice(NEWLINE_REGEX.finditer(data, pos), need - 1,
+                            None), None)
+        if match is None:
+            return None
+        end = match.end()
+        # each line in the block starts after b"\n"
+        block = data[pos - 1:end]
+        context = block.count(b"\n ")
+        inserts = block.count(b"\n+")
+        deletes = block.count(b"\n-")
+        # markers and CR are rare, the tests are faster than count()
+        markers = block.count(b"\n\\") if b"\\" in block else 0
+        if context + inserts + deletes + markers != need:
+            # empty or invalid lines
+            return None
+        srcneed -= context + deletes
+        tgtneed -= context + inserts
+        if srcneed < 0 or tgtneed < 0:
+            return None
+        lines += need
+        if b"\r" in block:
+            crlf += block.count(b"\r\n")
+        pos = end
+    return pos, lines, lines - crlf, crlf
+
+
+def _mixed_ends(ends):
+    """ return True if Patch.hunkends has more than one line end type """
+    return ((ends["cr"] != 0) + (ends["crlf"] != 0) + (ends["lf"] != 0)) > 1
+
+
+def _fsync_dir(path):
+    """ flush directory entries of `path` to disk """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # directories can not be opened on Windows
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def _capture(records):
+    """ collect log records of current thread into `records` list
+        (if it is not None) while in context
+    """
+    if records is None:
+        yield
+        return
+    _log_capture.local.records = records
+    try:
+        yield
+    finally:
+        _log_capture.local.records = None
+
+
 class PatchSetTypes(Enum):
     GIT = "git"
     HG = "mercurial"
@@ -48,28 +162,230 @@ class PatchSet(object):
         self.warnings = 0  # non-critical warnings
         # --- /API ---
 
+        # changed when patches in items are renamed
+        self._version = 0
+        # normalized source and target path -> (position, Patch), and
+        # the state (items, len(items), version) it was built for
+        self._paths = None
+        self._pathskey = None
+        # absolute source path -> (position, Patch), and the state
+        # (paths key, cwd) it was built for
+        self._sources = None
+        self._sourceskey = None
+
         if stream:
             self.parse(stream)
 
     def __len__(self):
         return len(self.items)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # copied patches don't report renames until indexed again
+        state["_paths"] = state["_pathskey"] = None
+        state["_sources"] = state["_sourceskey"] = None
+        return state
+
     def __iter__(self):
         for i in self.items:
             yield i
 
-    def parse(self, stream):
+    def __getitem__(self, path):
+        """ return the first Patch with source or target filename `path`
+            (str or bytes, normalized like patch filenames), raise
+            KeyError if there is none
+        """
+        p = self.get(path)
+        if p is None:
+            raise KeyError(path)
+        return p
+
+    def __contains__(self, path):
+        if isinstance(path, Patch):
+            return path in self.items
+        return self.get(path) is not None
+
+    def get(self, path, default=None):
+        """ return the first Patch with source or target filename `path`
+            like ps[path], or `default` if there is none. Lookups use an
+            index, which is built on first use.
+        """
+        p = self._find(xnormpath(os.fsencode(path)))
+        if p is None:
+            return default
+        return p
+
+    def _changed(self):
+        """ mark indexes of filenames out of date """
+        self._version = next(_versions)
+
+    def _find(self, path, sources=False):
+        """ return the first Patch with normalized filename `path`, or
+            with absolute source `path` if `sources` is set, or None
+        """
+        entry = self._index(sources).get(path)
+        if entry is not None and self.items[entry[0]] is not entry[1]:
+            # patch was replaced in place
+            self._pathskey = None
+            entry = self._index(sources).get(path)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def _index(self, sources=False):
+        """ return dict from normalized source and target filenames, or
+            from absolute source paths if `sources` is set, to (position,
+            Patch) of the first Patch with them. Indexes are rebuilt when
+            patches are added or removed, items list is replaced, indexed
+            patches are renamed, and the index of absolute paths also
+            when the current directory is different. Patches replaced in
+            place are detected by _find() when they are found.
+        """
+        items = self.items
+        # read before building, so renames while building are not lost
+        version = self._version
+        key = self._pathskey
+        if key is None or key[0] is not items or key[1] != len(items) or \
+                key[2] != version:
+            paths = {}
+            for entry in enumerate(items):
+                p = entry[1]
+                # renames of the patch change version of this PatchSet
+                p._watch(self)
+                for name in (p.source, p.target):
+                    if name is not None:
+                        paths.setdefault(xnormpath(name), entry)
+            self._paths = paths
+            self._pathskey = key = (items, len(items), version)
+        if not sources:
+            return self._paths
+
+        cwd = os.getcwd()
+        skey = self._sourceskey
+        if skey is None or skey[0] is not key or skey[1] != cwd:
+            index = {}
+            for entry in enumerate(items):
+                if entry[1].source is not None:
+                    name = os.fsencode(abspath(entry[1].source))
+                    index.setdefault(name, entry)
+            self._sources = index
+            self._sourceskey = (key, cwd)
+        return self._sources
+
+    def dump(self, fp):
+        """ write parsed patches to binary file object `fp` in a compact
+            format described in filepatch.serialize
+        """
+        from filepatch.serialize import dump
+        dump(self, fp)
+
+    @classmethod
+    def load(cls, fp, verify=False):
+        """ return PatchSet read from binary file object `fp` written by
+            dump(). Files are memory-mapped and hunk lines are read from
+            the mapping only when accessed. With `verify` checksum of
+            hunk lines is checked too, which reads them all.
+        """
+        from filepatch.serialize import load
+        patchset = cls()
+        load(fp, patchset, verify)
+        return patchset
+
+    def parse(self, stream, statsonly=False, lazy=False):
         """ parse unified diff
             return True on success
+
+            Hunk lines are stored as HunkText. If `stream` is an
+            `mmap.mmap`, hunk lines are not copied, but are kept as
+            offsets into the mapping.
+
+            With `statsonly` hunks are only counted in `inserts`,
+            `deletes` and `delta` of each Patch and are not kept, so
+            memory use depends on the number of files, not lines.
+            Such PatchSet can be used for diffstat(), but not applied.
+
+            With `lazy` and `mmap.mmap` stream, only line counts of
+            hunk headers are checked against the hunk bodies, which are
+            not read line by line. Hunk.text is loaded from the mapping
+            when it is accessed, and `inserts`, `deletes` and `delta` of
+            patches are None. Listing files of a large diff then costs
+            little more than scanning its headers.
+        """
+        before = len(self.items)
+        self.items.extend(self.iterparse(stream, statsonly, lazy))
+        return self.errors == 0 and len(self.items) > before
+
+    def iterparse(self, stream, statsonly=False, lazy=False):
+        """ parse unified diff and yield Patch objects one by one as soon
+            as they are complete, with detected type and normalized
+            filenames. Patches are not added to items, so memory use
+            doesn't grow with the size of the stream.
+
+            `errors`, `warnings` and `type` are updated while parsing,
+            final values are known when the generator is exhausted.
+            `statsonly` and `lazy` are the same as in parse().
+        """
+        if not isinstance(stream, mmap.mmap):
+            if lazy:
+                debug("lazy parsing needs mmap, reading hunks instead")
+            return self._iterparse(WrapEnumerate(stream), None, statsonly)
+        # lines are counted for stats
+        lazy = lazy and not statsonly
+        return self._iterparse(MappedLines(stream), stream, statsonly, lazy)
+
+    async def aparse(self, stream):
+        """ parse unified diff from asynchronous iterable of byte chunks
+            like parse(), return True on success
+        """
+        before = len(self.items)
+        async for p in self.aiterparse(stream):
+            self.items.append(p)
+        return self.errors == 0 and len(self.items) > before
+
+    async def aiterparse(self, stream):
+        """ asynchronous iterparse(), which reads chunks of data from
+            asynchronous iterable `stream`, for example a body of HTTP
+            response, and feeds them to the parser. Chunks don't have
+            to end at line boundaries.
+        """
+        feed = LineFeed()
+        parser = self._iterparse(feed)
+        async for chunk in stream:
+            feed.feed(chunk)
+            # parser yields None when it needs more data
+            p = next(parser)
+            while p is not None:
+                yield p
+                p = next(parser)
+        feed.close()
+        for p in parser:
+            yield p
+
+    def _iterparse(self, fe, mapping=None, statsonly=False, lazy=False):
+        """ parser state machine behind iterparse() and aiterparse(),
+            reading lines from WrapEnumerate, MappedLines or LineFeed `fe`
+
+            When LineFeed runs out of lines, the generator yields None
+            until more data is fed to it.
         """
         lineends = dict(lf=0, crlf=0, cr=0)
         #: even if index starts with 0 user messages number hunks from 1
         nexthunkno = 0
+        # number of parsed patches and hunks
+        patchno = 0
+        hunkstotal = 0
 
         p = None
         hunk = None
-        # hunkactual variable is used to calculate hunk lines for comparison
-        hunkactual = dict(linessrc=None, linestgt=None)
+        hunktext = None
+        # sizes of inserted and deleted lines of current hunk by line type
+        sizes = None
+        # position of hunk body in mapped stream
+        hunkstart = 0
+        # actual hunk lines counted for comparison with hunk header
+        srcseen = tgtseen = 0
+        # line ends of current hunk, added to Patch.hunkends when it is done
+        lf = crlf = cr = 0
 
         # define states (possible file regions) that direct parse flow
         headscan = True  # start with scanning header
@@ -84,6 +400,7 @@ class PatchSet(object):
         re_hunk_start = HUNK_REGEX
 
         self.errors = 0
+        self.type = None
         # temp buffers for header and filenames info
         header = []
         srcname = None
@@ -91,8 +408,9 @@ class PatchSet(object):
 
         # start of main cycle
         # each parsing block already has line available in fe.line
-        fe = WrapEnumerate(stream)
-        while fe.next():
+        # fe.wait() is reached only when next() returns False, and waits
+        # for more lines of asynchronous stream
+        while fe.next() or (yield from fe.wait()):
 
             # -- deciders: these only switch state to decide who should process
             # --           line fetched at the start of this cycle
@@ -110,7 +428,7 @@ class PatchSet(object):
             if headscan:
                 while not fe.is_empty and not fe.line.startswith(b"--- "):
                     header.append(fe.line)
-                    fe.next()
+                    fe.next() or (yield from fe.wait())
                 if fe.is_empty:
                     if p is None:
                         debug("no patch data found")  # error is shown later
@@ -135,34 +453,66 @@ class PatchSet(object):
             # hunkskip and hunkbody code skipped until definition of hunkhead
             # is parsed
             if hunkbody:
-                # [x] treat empty lines inside hunks as containing single space
-                #    (this happens when diff is saved by copy/pasting to editor
-                #     that strips trailing whitespace)
-                if line.strip(b"\r\n") == b"":
-                    debug("expanding empty line in a middle of hunk body")
-                    self.warnings += 1
-                    line = b' ' + line
-
-                # process line first
-                if re.match(b"^[- \\+\\\\]", line):
+                # fast path - consume well-formed body lines in a tight loop
+                # until line counts from hunk header are reached
+                linessrc = hunk.linessrc
+                linestgt = hunk.linestgt
+                append = hunktext.append
+                while True:
+                    kind = LINE_TYPES[line[0]] if line else BLANK
+                    if kind > MARKER:
+                        break
                     # gather stats about line endings
-                    if line.endswith(b"\r\n"):
-                        p.hunkends["crlf"] += 1
-                    elif line.endswith(b"\n"):
-                        p.hunkends["lf"] += 1
-                    elif line.endswith(b"\r"):
-                        p.hunkends["cr"] += 1
-
-                    if line.startswith(b"-"):
-                        hunkactual["linessrc"] += 1
-                    elif line.startswith(b"+"):
-                        hunkactual["linestgt"] += 1
-                    elif not line.startswith(b"\\"):
-                        hunkactual["linessrc"] += 1
-                        hunkactual["linestgt"] += 1
-                    hunk.text.append(line)
+                    last = line[-1:]
+                    if last == b"\n":
+                        if line[-2:-1] == b"\r":
+                            crlf += 1
+                        else:
+                            lf += 1
+                    elif last == b"\r":
+                        cr += 1
+                    if kind != MARKER:
+                        srcseen += SRC_LINES[kind]
+                        tgtseen += TGT_LINES[kind]
+                        if kind:
+                            sizes[kind] += len(line)
+                    append(line)
                     # todo: handle \ No newline cases
-                else:
+                    if srcseen >= linessrc or tgtseen >= linestgt:
+                        if srcseen > linessrc or tgtseen > linestgt or \
+                                srcseen == linessrc and tgtseen == linestgt:
+                            break
+                    if not fe.next() and not (yield from fe.wait()):
+                        break
+                    line = fe.line
+                lineno = fe.lineno
+
+                if fe.is_empty:
+                    # stream ended in the middle of hunk, line ends are
+                    # added after the loop
+                    continue
+
+                if kind == BLANK:
+                    # [x] treat empty lines inside hunks as containing single
+                    #    space (this happens when diff is saved by copy/pasting
+                    #    to editor that strips trailing whitespace)
+                    if line.strip(b"\r\n") == b"":
+                        debug("expanding empty line in a middle of hunk body")
+                        self.warnings += 1
+                        if line.endswith(b"\r\n"):
+                            crlf += 1
+                        elif line.endswith(b"\n"):
+                            lf += 1
+                        else:
+                            cr += 1
+                        srcseen += 1
+                        tgtseen += 1
+                        # stored as is, HunkText restores the leading space
+                        append(line)
+                    else:
+                        kind = INVALID
+
+                if kind == INVALID:
                     warning("invalid hunk no.%d at %d for target file %s"
                             % (nexthunkno, lineno+1, p.target))
                     # add hunk status node
@@ -174,8 +524,7 @@ class PatchSet(object):
                     hunkskip = True
 
                 # check exit conditions
-                if hunkactual["linessrc"] > hunk.linessrc or \
-                        hunkactual["linestgt"] > hunk.linestgt:
+                if srcseen > hunk.linessrc or tgtseen > hunk.linestgt:
                     warning("extra lines for hunk no.%d at %d for target %s"
                             % (nexthunkno, lineno+1, p.target))
                     # add hunk status node
@@ -185,21 +534,36 @@ class PatchSet(object):
                     # switch to hunkskip state
                     hunkbody = False
                     hunkskip = True
-                elif hunk.linessrc == hunkactual["linessrc"] and \
-                        hunk.linestgt == hunkactual["linestgt"]:
+                elif hunk.linessrc == srcseen and hunk.linestgt == tgtseen:
                     # hunk parsed successfully
                     p.hunks.append(hunk)
                     # switch to hunkparsed state
                     hunkbody = False
                     hunkparsed = True
 
-                    # detect mixed window/unix line ends
+                if not hunkbody:
+                    hunk.text = HunkText(hunktext, mapping, hunkstart)
+                    # stats of lazy patches are not known
+                    if not lazy:
+                        inserts = hunk.text.ops.count(INSERT)
+                        deletes = hunk.text.ops.count(DELETE)
+                        p.inserts += inserts
+                        p.deletes += deletes
+                        # line sizes include the leading + or -
+                        p.delta += (sizes[INSERT] - inserts -
+                                    sizes[DELETE] + deletes)
+                    if statsonly:
+                        # lines are counted, drop the hunk
+                        p.hunks.pop()
                     ends = p.hunkends
-                    line_ends_types = (
-                            (ends["cr"] != 0) +
-                            (ends["crlf"] != 0) +
-                            (ends["lf"] != 0))
-                    if line_ends_types > 1:
+                    ends["lf"] += lf
+                    ends["crlf"] += crlf
+                    ends["cr"] += cr
+                    lf = crlf = cr = 0
+
+                if hunkparsed:
+                    # detect mixed window/unix line ends
+                    if _mixed_ends(ends):
                         warning("inconsistent line ends in patch hunks for %s"
                                 % p.source)
                         self.warnings += 1
@@ -279,8 +643,12 @@ class PatchSet(object):
                             headscan = True
                         else:
                             if p:  # for the first run p is None
-                                self.items.append(p)
+                                hunkstotal += len(p.hunks)
+                                yield self._complete(p, patchno)
+                                patchno += 1
                             p = Patch()
+                            if not lazy:
+                                p.inserts = p.deletes = p.delta = 0
                             p.source = srcname
                             srcname = None
                             p.target = match.group(1).strip()
@@ -322,9 +690,38 @@ class PatchSet(object):
                         hunk.linestgt = int(match.group(6))
                     hunk.invalid = False
                     hunk.desc = match.group(7)[1:].rstrip()
-                    hunk.text = []
-
-                    hunkactual["linessrc"] = hunkactual["linestgt"] = 0
+                    # body lines are collected here and packed into
+                    # HunkText when the hunk is done
+                    hunktext = []
+                    sizes = [0, 0, 0]
+
+                    srcseen = tgtseen = 0
+                    if mapping is not None:
+                        hunkstart = mapping.tell()
+
+                    body = None
+                    if lazy:
+                        body = _skip_hunk(mapping, hunkstart, hunk.linessrc,
+                                          hunk.linestgt)
+                    if body is not None:
+                        # well-formed body is loaded when accessed
+                        end, lines, lf, crlf = body
+                        hunk.text = LazyText(mapping, hunkstart, end)
+                        p.hunks.append(hunk)
+                        fe.skip(end, lines)
+                        ends = p.hunkends
+                        ends["lf"] += lf
+                        ends["crlf"] += crlf
+                        lf = crlf = 0
+                        if _mixed_ends(ends):
+                            warning("inconsistent line ends in patch hunks "
+                                    "for %s" % p.source)
+                            self.warnings += 1
+                        # switch to hunkparsed state
+                        hunkhead = False
+                        hunkparsed = True
+                        nexthunkno += 1
+                        continue
 
                     # switch to hunkbody state
                     hunkhead = False
@@ -333,42 +730,46 @@ class PatchSet(object):
                     continue
 
         if p:
-            self.items.append(p)
+            # stream ended in the middle of hunk
+            ends = p.hunkends
+            ends["lf"] += lf
+            ends["crlf"] += crlf
+            ends["cr"] += cr
+            hunkstotal += len(p.hunks)
+            yield self._complete(p, patchno)
+            patchno += 1
 
         if not hunkparsed:
             if hunkskip:
                 warning("warning: finished with errors, "
                         "some hunks may be invalid")
             elif headscan:
-                if len(self.items) == 0:
+                if patchno == 0:
                     warning("error: no patch data found!")
-                    return False
+                    return
                 else:  # extra data at the end of file
                     pass
             else:
                 warning("error: patch stream is incomplete!")
                 self.errors += 1
-                if len(self.items) == 0:
-                    return False
+                if patchno == 0:
+                    return
 
         # XXX fix total hunks calculation
-        debug("total files: %d  total hunks: %d",
-              len(self.items), sum(len(p.hunks) for p in self.items))
+        debug("total files: %d  total hunks: %d", patchno, hunkstotal)
 
-        # ---- detect patch and patchset types ----
-        for idx, p in enumerate(self.items):
-            self.items[idx].type = self._detect_type(p)
-
-        types = set([p.type for p in self.items])
-        if len(types) > 1:
+    def _complete(self, p, idx):
+        """ detect type and normalize filenames for the parsed Patch
+            object with `idx` number in stream, update patchset type
+            return the Patch
+        """
+        p.type = self._detect_type(p)
+        if self.type is None:
+            self.type = p.type
+        elif self.type != p.type:
             self.type = PatchSetTypes.MIXED
-        else:
-            self.type = types.pop()
-        # --------
-
-        self._normalize_filenames()
-
-        return self.errors == 0
+        self._normalize_filenames(p, idx)
+        return p
 
     def _detect_type(self, p):
         """ detect and return type for the specified Patch object
@@ -433,8 +834,9 @@ class PatchSet(object):
 
         return PatchSetTypes.PLAIN
 
-    def _normalize_filenames(self):
-        """ sanitize filenames, normalizing paths, i.e.:
+    def _normalize_filenames(self, p, i):
+        """ sanitize filenames of Patch `p` with index `i`, normalizing
+            paths, i.e.:
             1. strip a/ and b/ prefixes from GIT and HG style patches
             2. remove all references to parent directories (with warning)
             3. translate any absolute paths to relative (with warning)
@@ -444,108 +846,124 @@ class PatchSet(object):
 
             return None
         """
-        for i, p in enumerate(self.items):
-            if p.type in (PatchSetTypes.HG, PatchSetTypes.GIT):
-                # TODO: figure out how to deal with /dev/null entries
-                debug("stripping a/ and b/ prefixes")
-                if p.source != '/dev/null':
-                    if not p.source.startswith(b"a/"):
-                        warning("invalid source filename")
-                    else:
-                        p.source = p.source[2:]
-                if p.target != '/dev/null':
-                    if not p.target.startswith(b"b/"):
-                        warning("invalid target filename")
-                    else:
-                        p.target = p.target[2:]
-
-            p.source = xnormpath(p.source)
-            p.target = xnormpath(p.target)
-
-            sep = b'/'
-
-            # references to parent are not allowed
-            if p.source.startswith(b".." + sep):
-                warning("error: stripping parent path for source file patch "
-                        "no.%d" % (i+1))
-                self.warnings += 1
-                while p.source.startswith(b".." + sep):
-                    p.source = p.source.partition(sep)[2]
-            if p.target.startswith(b".." + sep):
-                warning("error: stripping parent path for target file patch "
-                        "no.%d" % (i+1))
-                self.warnings += 1
-                while p.target.startswith(b".." + sep):
-                    p.target = p.target.partition(sep)[2]
-            # absolute paths are not allowed
-            if xisabs(p.source) or xisabs(p.target):
-                warning("error: absolute paths are not allowed - file no.%d"
-                        % (i+1))
-                self.warnings += 1
-                if xisabs(p.source):
-                    warning("stripping absolute path from source name '%s'"
-                            % p.source)
-                    p.source = xstrip(p.source)
-                if xisabs(p.target):
-                    warning("stripping absolute path from target name '%s'"
-                            % p.target)
-                    p.target = xstrip(p.target)
-
-            self.items[i].source = p.source
-            self.items[i].target = p.target
-
-    def diffstat(self):
+        self._changed()
+        if p.type in (PatchSetTypes.HG, PatchSetTypes.GIT):
+            # TODO: figure out how to deal with /dev/null entries
+            debug("stripping a/ and b/ prefixes")
+            if p.source != '/dev/null':
+                if not p.source.startswith(b"a/"):
+                    warning("invalid source filename")
+                else:
+                    p.source = p.source[2:]
+            if p.target != '/dev/null':
+                if not p.target.startswith(b"b/"):
+                    warning("invalid target filename")
+                else:
+                    p.target = p.target[2:]
+
+        p.source = xnormpath(p.source)
+        p.target = xnormpath(p.target)
+
+        sep = b'/'
+
+        # references to parent are not allowed
+        if p.source.startswith(b".." + sep):
+            warning("error: stripping parent path for source file patch "
+                    "no.%d" % (i+1))
+            self.warnings += 1
+            while p.source.startswith(b".." + sep):
+                p.source = p.source.partition(sep)[2]
+        if p.target.startswith(b".." + sep):
+            warning("error: stripping parent path for target file patch "
+                    "no.%d" % (i+1))
+            self.warnings += 1
+            while p.target.startswith(b".." + sep):
+                p.target = p.target.partition(sep)[2]
+        # absolute paths are not allowed
+        if xisabs(p.source) or xisabs(p.target):
+            warning("error: absolute paths are not allowed - file no.%d"
+                    % (i+1))
+            self.warnings += 1
+            if xisabs(p.source):
+                warning("stripping absolute path from source name '%s'"
+                        % p.source)
+                p.source = xstrip(p.source)
+            if xisabs(p.target):
+                warning("stripping absolute path from target name '%s'"
+                        % p.target)
+                p.target = xstrip(p.target)
+
+    def diffstat_data(self, reverse=False):
+        """ return list of (filename, inserted lines, deleted lines, size
+            change in bytes) tuples for each patch, which diffstat() shows.
+            With `reverse` the numbers are for patches applied in reverse
+            direction, and filenames are source filenames.
+        """
+        data = []
+        for patch in self.items:
+            if patch.inserts is not None:
+                # counted by parser
+                i, d, delta = patch.inserts, patch.deletes, patch.delta
+            else:
+                i = d = delta = 0
+                for hunk in patch.hunks:
+                    text = hunk.text
+                    if not isinstance(text, HunkText):
+                        text = HunkText(text)
+                    hi, hd, hdelta = text.stats()
+                    i += hi
+                    d += hd
+                    delta += hdelta
+            if reverse:
+                data.append((patch.source, d, i, -delta))
+            else:
+                data.append((patch.target, i, d, delta))
+        return data
+
+    def diffstat(self, reverse=False):
         """ calculate diffstat and return as a string
             Notes:
               - original diffstat ouputs target filename
               - single + or - shouldn't escape histogram
+            `reverse` is the same as in diffstat_data()
         """
-        names = []
-        insert = []
-        delete = []
-        delta = 0    # size change in bytes
-        namelen = 0
-        maxdiff = 0  # max number of changes for single file
+        data = self.diffstat_data(reverse)
+        namelen = max([len(name) for name, i, d, delta in data], default=0)
+        # max number of changes for single file
         # (for histogram width calculation)
-        for patch in self.items:
-            i, d = 0, 0
-            for hunk in patch.hunks:
-                for line in hunk.text:
-                    if line.startswith(b'+'):
-                        i += 1
-                        delta += len(line)-1
-                    elif line.startswith(b'-'):
-                        d += 1
-                        delta -= len(line)-1
-            names.append(patch.target)
-            insert.append(i)
-            delete.append(d)
-            namelen = max(namelen, len(patch.target))
-            maxdiff = max(maxdiff, i+d)
-        output = ''
+        maxdiff = max([i + d for name, i, d, delta in data], default=0)
         statlen = len(str(maxdiff))  # stats column width
-        for i, n in enumerate(names):
-            format = " %-" + str(namelen) + "s | %" + str(statlen) + "s %s\n"
+        format = " %-" + str(namelen) + "s | %" + str(statlen) + "s %s\n"
+        histwidth = max(2, 80 - len(format % ('', '', '')))
+
+        output = []
+        # histograms are the same for the same numbers of changes
+        hists = {}
+        inserts = deletes = total = 0
+        for name, i, d, delta in data:
             # -- calculating histogram --
-            width = len(format % ('', '', ''))
-            histwidth = max(2, 80 - width)
-            if maxdiff < histwidth:
-                hist = "+"*insert[i] + "-"*delete[i]
-            else:
-                iratio = (float(insert[i]) / maxdiff) * histwidth
-                dratio = (float(delete[i]) / maxdiff) * histwidth
-
-                # make sure every entry gets at least one + or -
-                iwidth = 1 if 0 < iratio < 1 else int(iratio)
-                dwidth = 1 if 0 < dratio < 1 else int(dratio)
-                hist = "+"*int(iwidth) + "-"*int(dwidth)
+            hist = hists.get((i, d))
+            if hist is None:
+                if maxdiff < histwidth:
+                    hist = "+"*i + "-"*d
+                else:
+                    iratio = (float(i) / maxdiff) * histwidth
+                    dratio = (float(d) / maxdiff) * histwidth
+
+                    # make sure every entry gets at least one + or -
+                    iwidth = 1 if 0 < iratio < 1 else int(iratio)
+                    dwidth = 1 if 0 < dratio < 1 else int(dratio)
+                    hist = "+"*iwidth + "-"*dwidth
+                hists[(i, d)] = hist
             # -- /calculating +- histogram --
-            output += (format % (
-                names[i].decode('utf-8'), str(insert[i] + delete[i]), hist))
+            output.append(format % (name.decode('utf-8'), i + d, hist))
+            inserts += i
+            deletes += d
+            total += delta
 
-        output += (" %d files changed, %d insertions(+), %d deletions(-), %+d "
-                   "bytes" % (len(names), sum(insert), sum(delete), delta))
-        return output
+        output.append(" %d files changed, %d insertions(+), %d deletions(-),"
+                      " %+d bytes" % (len(data), inserts, deletes, total))
+        return "".join(output)
 
     def findfile(self, old, new):
         """ return name of file to be patched or None """
@@ -566,171 +984,362 @@ class PatchSet(object):
                     return new
             return None
 
-    def apply(self, strip=0, root=None):
+    def apply(self, strip=0, root=None, workers=None, transactional=False,
+              fsync=False, fuzz=None, reverse=False, newline="auto"):
         """ Apply parsed patch, optionally stripping leading components
             from file paths. `root` parameter specifies working dir.
+            `workers` sets the number of threads that patch different
+            files in parallel. Patches for the same file are applied in
+            order, and log messages are emitted in the same order as
+            when patching sequentially.
+
+            In `transactional` mode all patches are validated first, and
+            patched files are written next to originals. Only if there
+            are no errors, originals are replaced with os.replace(), and
+            if that fails, already replaced files are restored.
+
+            Patched file is written to a temporary file, which replaces
+            the original. With `fsync` it is flushed to disk before, and
+            each changed directory is synced once after all files.
+
+            By default hunks must match at their lines. With `fuzz` set to
+            a number, a hunk that doesn't match is applied at the nearest
+            position where it does (an offset), ignoring up to `fuzz`
+            lines of its leading and trailing context if needed, like
+            GNU patch. Offset and fuzz of such hunks are logged.
+
+            With `reverse` hunks are applied in reverse direction, the
+            same way as revert() does.
+
+            `newline` sets line ends of added lines. "auto" converts them
+            to line ends of patched file if they are consistent, "lf" or
+            "crlf" always use LF or CRLF, and "preserve" keeps line ends
+            from the patch.
             return True on success
         """
+        if newline not in NEWLINES:
+            raise ValueError("newline must be one of %s, not %r"
+                             % (", ".join(NEWLINES), newline))
         if root:
             prevdir = os.getcwd()
             os.chdir(root)
 
-        total = len(self.items)
-        errors = 0
-        if strip:
-            # [ ] test strip level exceeds nesting level
-            #   [ ] test the same only for selected files
-            #     [ ] test if files end up being on the same level
-            try:
-                strip = int(strip)
-            except ValueError:
-                errors += 1
-                warning("error: strip parameter '%s' must be an integer"
-                        % strip)
-                strip = 0
-
-        for i, p in enumerate(self.items):
+        try:
+            total = len(self.items)
+            errors = 0
             if strip:
-                debug("stripping %s leading component(s) from:" % strip)
-                debug("   %s" % p.source)
-                debug("   %s" % p.target)
-                old = pathstrip(p.source, strip)
-                new = pathstrip(p.target, strip)
-            else:
-                old, new = p.source, p.target
+                # [ ] test strip level exceeds nesting level
+                #   [ ] test the same only for selected files
+                #     [ ] test if files end up being on the same level
+                try:
+                    strip = int(strip)
+                except ValueError:
+                    errors += 1
+                    warning("error: strip parameter '%s' must be an integer"
+                            % strip)
+                    strip = 0
+
+            parallel = workers is not None and workers > 1
+            grouped = parallel or transactional
+            # patches grouped by file they are applied to
+            files = OrderedDict()
+            # log records held back for each patch in parallel mode
+            records = [[] for i in range(total)] if parallel else None
+            # directories to sync
+            dirs = set()
+
+            for i, p in enumerate(self.items):
+                with _capture(records[i] if parallel else None):
+                    filename = self._resolve(p, strip)
+                    if not filename:
+                        errors += 1
+                        continue
+                    if fsync:
+                        dirs.add(dirname(abspath(filename)))
+                    if not grouped:
+                        errors += self._apply_patch(i, total, p, filename,
+                                                    fsync, fuzz, reverse,
+                                                    newline)
+                        continue
+                key = os.path.realpath(filename)
+                files.setdefault(key, []).append((i, p, filename))
 
-            filename = self.findfile(old, new)
+            if transactional:
+                task = self._stage_patches
+            else:
+                task = self._apply_patches
+            results = []
+            # the first exception raised by a task
+            failure = None
+            if parallel and files:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(workers) as pool:
+                    tasks = [pool.submit(task, group, total, records, fsync,
+                                         fuzz, reverse, newline)
+                             for group in files.values()]
+                for t in tasks:
+                    if t.exception() is None:
+                        results.append(t.result())
+                    elif failure is None:
+                        failure = t.exception()
+            else:
+                try:
+                    for group in files.values():
+                        results.append(task(group, total, records, fsync, fuzz,
+                                            reverse, newline))
+                except Exception as e:
+                    failure = e
+            if failure is not None:
+                if transactional:
+                    # files staged by other groups are not committed
+                    for result in results:
+                        if result[1] is not None:
+                            os.unlink(result[1])
+                raise failure
+            if records:
+                for patchrecords in records:
+                    for record in patchrecords:
+                        logger.handle(record)
+
+            errors += sum(result[0] for result in results)
+            if transactional:
+                staged = [(group, result[1])
+                          for group, result in zip(files.values(), results)
+                          if result[1] is not None]
+                if errors:
+                    warning("patch is not applied, no files are changed")
+                    for group, tmpname in staged:
+                        os.unlink(tmpname)
+                elif self._commit(staged):
+                    patched = sorted(item for group, tmpname in staged
+                                     for item in group)
+                    for i, p, filename in patched:
+                        info("successfully patched %d/%d:\t %s"
+                             % (i+1, total, filename))
+                else:
+                    errors += 1
 
-            if not filename:
-                warning("source/target file does not exist:\n  --- %s\n"
-                        "  +++ %s" % (old, new))
-                errors += 1
-                continue
-            if not isfile(filename):
-                warning("not a file - %s" % filename)
-                errors += 1
-                continue
+            for path in sorted(dirs):
+                _fsync_dir(path)
 
-            # [ ] check absolute paths security here
-            debug("processing %d/%d:\t %s" % (i+1, total, filename))
-
-            # validate before patching
-            f2fp = open(filename, 'rb')
-            hunkno = 0
-            hunk = p.hunks[hunkno]
-            hunkfind = []
-            validhunks = 0
-            canpatch = False
-            for lineno, line in enumerate(f2fp):
-                if lineno+1 < hunk.startsrc:
-                    continue
-                elif lineno+1 == hunk.startsrc:
-                    hunkfind = [x[1:].rstrip(b"\r\n") for x in hunk.text if
-                                x[0] in b" -"]
-                    hunklineno = 0
+            # todo: check for premature eof
+            return errors == 0
+        finally:
+            if root:
+                os.chdir(prevdir)
 
-                    # todo \ No newline at end of file
+    def _resolve(self, p, strip):
+        """ return name of existing file to apply Patch `p` to or None """
+        if strip:
+            debug("stripping %s leading component(s) from:" % strip)
+            debug("   %s" % p.source)
+            debug("   %s" % p.target)
+            old = pathstrip(p.source, strip)
+            new = pathstrip(p.target, strip)
+        else:
+            old, new = p.source, p.target
 
-                # check hunks in source file
-                if lineno+1 < hunk.startsrc+len(hunkfind)-1:
-                    if line.rstrip(b"\r\n") == hunkfind[hunklineno]:
-                        hunklineno += 1
-                    else:
-                        errors += 1
-                        info("file %d/%d:\t %s" % (i+1, total, filename))
-                        info(" hunk no.%d doesn't match source file at line %d"
-                             % (hunkno+1, lineno+1))
-                        info("  expected: %s" % hunkfind[hunklineno])
-                        info("  actual  : %s" % line.rstrip(b"\r\n"))
-                        # not counting this as error, because file may already
-                        # be patched. check if file is already patched is done
-                        # after the number of invalid hunks if found
-                        # TODO: check hunks against source/target file in one
-                        # pass
-                        #   API - check(stream, srchunks, tgthunks)
-                        #           return tuple (srcerrs, tgterrs)
-
-                        # continue to check other hunks for completeness
-                        hunkno += 1
-                        if hunkno < len(p.hunks):
-                            hunk = p.hunks[hunkno]
-                            continue
-                        else:
-                            break
+        filename = self.findfile(old, new)
 
-                # check if processed line is the last line
-                if lineno+1 == hunk.startsrc+len(hunkfind)-1:
-                    debug(" hunk no.%d for file %s  -- is ready to be patched"
-                          % (hunkno+1, filename))
-                    hunkno += 1
-                    validhunks += 1
-                    if hunkno < len(p.hunks):
-                        hunk = p.hunks[hunkno]
-                    else:
-                        if validhunks == len(p.hunks):
-                            # patch file
-                            canpatch = True
-                            break
-            else:
-                if hunkno < len(p.hunks):
-                    warning("premature end of source file %s at hunk %d"
-                            % (filename, hunkno+1))
-                    errors += 1
+        if not filename:
+            warning("source/target file does not exist:\n  --- %s\n"
+                    "  +++ %s" % (old, new))
+            return None
+        if not isfile(filename):
+            warning("not a file - %s" % filename)
+            return None
+        return filename
 
-            f2fp.close()
+    def _apply_patches(self, group, total, records, fsync=False,
+                       fuzz=None, reverse=False, newline="auto"):
+        """ apply (index, Patch, filename) items from `group` one after
+            another, holding back log records for each of them
+            return (number of errors, None)
+        """
+        errors = 0
+        for i, p, filename in group:
+            with _capture(records[i] if records else None):
+                errors += self._apply_patch(i, total, p, filename, fsync,
+                                            fuzz, reverse, newline)
+        return errors, None
+
+    def _stage_patches(self, group, total, records, fsync=False,
+                       fuzz=None, reverse=False, newline="auto"):
+        """ validate (index, Patch, filename) items from `group` against
+            the file, and write the patched file to a temporary file in
+            the same directory, applying patches one after another
+            return (number of errors, name of temporary file or None)
+        """
+        import shutil
+        errors = 0
+        staged = None
+        tmpname = None
+        try:
+            for i, p, filename in group:
+                with _capture(records[i] if records else None):
+                    source = staged or filename
+                    tgt, tmpname = self._tempfile(filename)
+                    with tgt:
+                        patcherrors, canpatch = self._patch_file(
+                            i, total, p, filename, source, tgt, fuzz,
+                            reverse, newline)
+                        if canpatch and fsync:
+                            tgt.flush()
+                            os.fsync(tgt.fileno())
+                    errors += patcherrors
+                    if not canpatch:
+                        os.unlink(tmpname)
+                        continue
+                    shutil.copymode(source, tmpname)
+                    debug("patched %d/%d:\t %s is staged to %s"
+                          % (i+1, total, filename, tmpname))
+                    if staged:
+                        os.unlink(staged)
+                    staged = tmpname
+        except Exception:
+            for name in (tmpname, staged):
+                if name is not None and exists(name):
+                    os.unlink(name)
+            raise
+        return errors, staged
+
+    def _tempfile(self, filename):
+        """ create temporary file next to `filename`
+            return (file object opened for writing, name)
+        """
+        import tempfile
+        filename = os.fsencode(filename)
+        fd, tmpname = tempfile.mkstemp(prefix=basename(filename) + b".",
+                                       dir=dirname(filename) or b".")
+        return os.fdopen(fd, "wb"), tmpname
+
+    def _commit(self, staged):
+        """ replace files with temporary files from (group, tmpname) items
+            of `staged`, restore original files if it fails
+            return True on success
+        """
+        import shutil
+        backups = []
+        backup = None
+        try:
+            for group, tmpname in staged:
+                filename = group[0][2]
+                # hard link keeps the original without copying data
+                backup = tmpname + b".orig"
+                try:
+                    os.link(filename, backup)
+                except OSError:
+                    shutil.copy2(filename, backup)
+                os.replace(tmpname, filename)
+                backups.append((filename, backup))
+                backup = None
+        except OSError as e:
+            warning("error replacing %s - %s, restoring original files"
+                    % (filename, e))
+            if backup and exists(backup):
+                os.unlink(backup)
+            for filename, backup in reversed(backups):
+                os.replace(backup, filename)
+            for group, tmpname in staged:
+                if exists(tmpname):
+                    os.unlink(tmpname)
+            return False
+        for filename, backup in backups:
+            os.unlink(backup)
+        return True
 
-            if validhunks < len(p.hunks):
-                if self._match_file_hunks(filename, p.hunks):
-                    warning("already patched  %s" % filename)
-                else:
-                    warning("source file is different - %s" % filename)
-                    errors += 1
-            if canpatch:
-                backupname = filename+b".orig"
-                if exists(backupname):
-                    warning("can't backup original file to %s - aborting"
-                            % backupname)
-                else:
-                    import shutil
-                    shutil.move(filename, backupname)
-                    if self.write_hunks(backupname, filename, p.hunks):
-                        info("successfully patched %d/%d:\t %s"
-                             % (i+1, total, filename))
-                        os.unlink(backupname)
-                    else:
-                        errors += 1
-                        warning("error patching file %s" % filename)
-                        shutil.copy(filename, filename+".invalid")
-                        warning("invalid version is saved to %s"
-                                % filename+".invalid")
-                        # todo: proper rejects
-                        shutil.move(backupname, filename)
+    def _apply_patch(self, i, total, p, filename, fsync=False, fuzz=None,
+                     reverse=False, newline="auto"):
+        """ apply Patch `p` with index `i` to existing file `filename`
+            return number of errors
+        """
+        import shutil
+        tgt, tmpname = self._tempfile(filename)
+        try:
+            with tgt:
+                errors, canpatch = self._patch_file(i, total, p, filename,
+                                                    filename, tgt, fuzz,
+                                                    reverse, newline)
+                if canpatch and fsync:
+                    tgt.flush()
+                    os.fsync(tgt.fileno())
+            if not canpatch:
+                os.unlink(tmpname)
+                return errors
+
+            # readers see either original or patched file, never a
+            # missing one
+            shutil.copymode(filename, tmpname)
+            os.replace(tmpname, filename)
+        except Exception:
+            if exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        info("successfully patched %d/%d:\t %s" % (i+1, total, filename))
+        return errors
+
+    def _patch_file(self, i, total, p, filename, source, tgt, fuzz=None,
+                    reverse=False, newline="auto"):
+        """ validate Patch `p` with index `i` against `filename` (or its
+            patched copy `source`) and write patched file to `tgt` in a
+            single pass. If the patch doesn't match, the same pass checks
+            if the file is already patched. With `fuzz` hunks are placed
+            by _place_hunks() instead. `reverse` applies hunks in reverse,
+            `newline` is the policy for line ends of added lines.
+            return (number of errors, True if patch is applied)
+        """
+        errors = 0
+        # [ ] check absolute paths security here
+        debug("processing %d/%d:\t %s" % (i+1, total, filename))
+
+        check = dict(mismatch=[], eof=None, patched=True)
+        if fuzz is None:
+            with open(source, 'rb') as src:
+                tgt.writelines(self._patched_lines(src, p.hunks, check,
+                                                   reverse, newline))
+        else:
+            with open(source, 'rb') as src:
+                data = src.read()
+            lines = BytesIO(data).readlines()
+            spans = self._place_hunks(lines, p.hunks, fuzz, check, reverse)
+            if not check["mismatch"] and check["eof"] is None:
+                tgt.writelines(self._placed_lines(BytesIO(data), spans,
+                                                  reverse, newline))
+            for hunkno, lineno, offset, hunkfuzz in check["placed"]:
+                if offset or hunkfuzz:
+                    info(" hunk no.%d applied at line %d (offset %d lines,"
+                         " fuzz %d)" % (hunkno+1, lineno, offset, hunkfuzz))
+
+        for hunkno, lineno, expected, actual in check["mismatch"]:
+            # not counting this as error, because file may already
+            # be patched. check if file is already patched is done
+            # after the number of invalid hunks if found
+            errors += 1
+            info("file %d/%d:\t %s" % (i+1, total, filename))
+            info(" hunk no.%d doesn't match source file at line %d"
+                 % (hunkno+1, lineno))
+            info("  expected: %s" % expected)
+            info("  actual  : %s" % actual)
+        if check["eof"] is not None:
+            warning("premature end of source file %s at hunk %d"
+                    % (filename, check["eof"]+1))
+            errors += 1
+
+        canpatch = not check["mismatch"] and check["eof"] is None
+        if canpatch:
+            debug(" all %d hunks for file %s  -- are patched"
+                  % (len(p.hunks), filename))
+        elif check["patched"]:
+            warning("already patched  %s" % filename)
+        else:
+            warning("source file is different - %s" % filename)
+            errors += 1
+        return errors, canpatch
 
-        if root:
-            os.chdir(prevdir)
-
-        # todo: check for premature eof
-        return errors == 0
-
-    def _reverse(self):
-        """ reverse patch direction (this doesn't touch filenames) """
-        for p in self.items:
-            for h in p.hunks:
-                h.startsrc, h.starttgt = h.starttgt, h.startsrc
-                h.linessrc, h.linestgt = h.linestgt, h.linessrc
-                for i, line in enumerate(h.text):
-                    # need to use line[0:1] here, because line[0]
-                    # returns int instead of bytes on Python 3
-                    if line[0:1] == b'+':
-                        h.text[i] = b'-' + line[1:]
-                    elif line[0:1] == b'-':
-                        h.text[i] = b'+' + line[1:]
-
-    def revert(self, strip=0, root=None):
+    def revert(self, strip=0, root=None, fuzz=None, newline="auto"):
         """ apply patch in reverse order """
-        reverted = copy.deepcopy(self)
-        reverted._reverse()
-        return reverted.apply(strip, root)
+        return self.apply(strip, root, fuzz=fuzz, reverse=True,
+                          newline=newline)
 
     def can_patch(self, filename):
         """ Check if specified filename can be patched. Returns None if file
@@ -739,11 +1348,23 @@ class PatchSet(object):
 
         :returns: True, False or None
         """
-        filename = abspath(filename)
-        for p in self.items:
-            if filename == abspath(p.source):
-                return self._match_file_hunks(filename, p.hunks)
-        return None
+        p = self._find(os.fsencode(abspath(filename)), sources=True)
+        if p is None:
+            return None
+        return self._match_file_hunks(filename, p.hunks)
+
+    def can_patch_many(self, filenames, workers=None):
+        """ Check a list of `filenames` like can_patch(), looking them up
+            in the same index of source filenames. `workers` sets the
+            number of threads that check files in parallel.
+
+        :returns: list of True, False or None for each filename
+        """
+        if workers is not None and workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as pool:
+                return list(pool.map(self.can_patch, filenames))
+        return [self.can_patch(filename) for filename in filenames]
 
     def _match_file_hunks(self, filepath, hunks):
         matched = True
@@ -764,15 +1385,13 @@ class PatchSet(object):
                         raise NoMatch
                     line = fp.readline()
                     lineno += 1
-                for hline in h.text:
-                    if hline.startswith(b"-"):
-                        continue
+                for hline in h.target_lines:
                     if not len(line):
                         debug("check failed - premature eof on hunk: %d"
                               % (hno+1))
                         # todo: \ No newline at the end of file
                         raise NoMatch
-                    if line.rstrip(b"\r\n") != hline[1:].rstrip(b"\r\n"):
+                    if line.rstrip(b"\r\n") != hline:
                         debug("file is not patched - failed hunk: %d"
                               % (hno+1))
                         raise NoMatch
@@ -786,76 +1405,373 @@ class PatchSet(object):
         fp.close()
         return matched
 
-    def patch_stream(self, instream, hunks):
-        """ Generator that yields stream patched with hunks iterable
+    def _patched_lines(self, instream, hunks, check, reverse=False,
+                       newline="auto"):
+        """ Generator that yields lines of `instream` patched with `hunks`,
+            comparing source lines with hunks on the way and lines of
+            `instream` with hunk targets to detect if it is already
+            patched. Results are stored in `check` dict:
+              mismatch - list of (hunk index, line number, expected line,
+                         actual line) for each hunk that doesn't match
+              eof      - index of hunk where source ended prematurely
+              patched  - True if `instream` matches hunk targets
+            Output stops at the first difference. With `reverse` hunks
+            are read in reverse direction. Lines outside of hunks and
+            their targets are yielded in blocks.
+
+            Converts lineends in hunk lines like patch_stream()
+        """
+        mismatch = check["mismatch"]
+        detect = newline == "auto"
+        newline = NEWLINES[newline]
+        types = REVERSED_LINE_TYPES if reverse else LINE_TYPES
+        reader = BlockReader(instream)
+
+        # target windows - (first line, lines) of each hunk target
+        if reverse:
+            targets = [(h.startsrc, h.source_lines) for h in hunks]
+        else:
+            targets = [(h.starttgt, h.target_lines) for h in hunks]
+        # last line of target windows
+        tgtend = max([start + len(lines) - 1 for start, lines in targets],
+                     default=0)
+        targets.reverse()
+        # line number and lines of current target window
+        tgtstart, tgtlines = targets.pop() if targets else (None, None)
+
+        def get_line():
+            """ read line from source stream, comparing it with hunk
+                targets
+            """
+            nonlocal tgtstart, tgtlines
+            line = reader.readline()
+            if not line:
+                return line
+            srclineno = reader.lineno
+
+            while tgtlines is not None and srclineno >= tgtstart:
+                if srclineno - tgtstart < len(tgtlines):
+                    if line.rstrip(b"\r\n") != \
+                            tgtlines[srclineno - tgtstart]:
+                        check["patched"] = False
+                        tgtlines = None
+                    break
+                tgtstart, tgtlines = targets.pop() if targets else \
+                    (None, None)
+            return line
+
+        def copy_lines(lineno):
+            """ yield source lines up to `lineno` in blocks, reading lines
+                of target windows one by one
+            """
+            while reader.lineno < lineno:
+                if tgtlines is not None and reader.lineno + 1 >= tgtstart:
+                    line = get_line()
+                    if not line:
+                        return
+                    yield line
+                    continue
+                end = lineno if tgtlines is None else \
+                    min(lineno, tgtstart - 1)
+                for block in reader.lines(end - reader.lineno):
+                    yield block
+                if reader.lineno < end:
+                    return
+
+        for hno, h in enumerate(hunks):
+            if reverse:
+                startsrc, linessrc = h.starttgt, h.linestgt
+            else:
+                startsrc, linessrc = h.startsrc, h.linessrc
+            # hunk without source lines is inserted after startsrc line
+            firstline = startsrc + 1 if linessrc == 0 else startsrc
+            for block in copy_lines(firstline - 1):
+                if not mismatch:
+                    yield block
+            if reader.lineno < firstline - 1:
+                check["eof"] = hno
+                break
+
+            if reverse:
+                hunksrc, hunktgt = h.target_lines, h.source_lines
+            else:
+                hunksrc, hunktgt = h.source_lines, h.target_lines
+            # index of current source and target line of the hunk
+            srcidx = tgtidx = 0
+            hunkmatch = True
+            for hline in h.text:
+                kind = types[hline[0]]
+                if kind == MARKER:
+                    # todo: check \ No newline at the end of file
+                    continue
+                if kind != INSERT:
+                    line = get_line()
+                    if not line:
+                        check["eof"] = hno
+                        break
+                    if hunkmatch and \
+                            line.rstrip(b"\r\n") != hunksrc[srcidx]:
+                        mismatch.append((hno, reader.lineno,
+                                         hunksrc[srcidx],
+                                         line.rstrip(b"\r\n")))
+                        hunkmatch = False
+                    srcidx += 1
+                    if kind == DELETE:
+                        continue
+                tgtidx += 1
+                if mismatch:
+                    continue
+                if kind != INSERT and line.endswith((b"\n", b"\r")):
+                    # context lines keep line ends of the file
+                    yield line
+                    continue
+                if detect:
+                    # None if line ends are mixed in source file
+                    newline = reader.newline()
+                if newline is not None:
+                    yield hunktgt[tgtidx - 1] + newline
+                else:
+                    yield hline[1:]
+            if check["eof"] is not None:
+                break
+
+        # compare the rest of target windows
+        for block in copy_lines(tgtend):
+            if not mismatch:
+                yield block
+        if not mismatch:
+            for block in reader.rest():
+                yield block
+        # source ended before the end of target windows
+        if tgtlines is not None:
+            targets.append((tgtstart, tgtlines))
+            if any(start + len(lines) - 1 > reader.lineno
+                   for start, lines in targets if lines):
+                check["patched"] = False
+
+    def _place_hunks(self, lines, hunks, fuzz, check, reverse=False):
+        """ Find where `hunks` are in the list of source file `lines`.
+            A hunk that doesn't match at its line is looked up in the
+            index of lines at the nearest position where it matches,
+            ignoring up to `fuzz` lines of leading and trailing context
+            if there is no such position. `reverse` reverses hunks.
+
+            Fills `check` dict like _patched_lines() and adds `placed`
+            list of (hunk index, line number, offset, fuzz) for each
+            found hunk.
+            return list of (index of the first matched line, hunk lines
+            without ignored context)
+        """
+        stripped = [line.rstrip(b"\r\n") for line in lines]
+        types = REVERSED_LINE_TYPES if reverse else LINE_TYPES
+        index = None
+        spans = []
+        placed = check["placed"] = []
+        offset = 0
+        # hunks are applied in order and may not overlap
+        start = 0
+        for hno, h in enumerate(hunks):
+            text = [x for x in h.text if types[x[0]] != MARKER]
+            kinds = [types[x[0]] for x in text]
+            # number of leading and trailing context lines
+            head = 0
+            while head < len(kinds) and kinds[head] == CONTEXT:
+                head += 1
+            tail = 0
+            while tail < len(kinds) - head and kinds[-1-tail] == CONTEXT:
+                tail += 1
+
+            if reverse:
+                startsrc, linessrc = h.starttgt, h.linestgt
+            else:
+                startsrc, linessrc = h.startsrc, h.linessrc
+            srclines = h.target_lines if reverse else h.source_lines
+            # hunk without source lines is inserted after startsrc line
+            hunkstart = startsrc if linessrc == 0 else startsrc - 1
+            pos = None
+            for hunkfuzz in range(min(fuzz, max(head, tail)) + 1):
+                skip = min(hunkfuzz, head)
+                core = text[skip:len(text) - min(hunkfuzz, tail)]
+                # ignored lines are context, which is in source lines
+                pattern = list(srclines[skip:len(srclines) -
+                                        min(hunkfuzz, tail)])
+                expected = hunkstart + offset + skip
+                if start <= expected <= len(lines) - len(pattern) and \
+                        stripped[expected:expected+len(pattern)] == pattern:
+                    pos = expected
+                    break
+                if index is None:
+                    index = LineIndex(stripped)
+                pos = index.find(pattern, expected, start)
+                if pos is not None:
+                    break
+
+            if pos is None:
+                # report the first line that differs at hunk position
+                pattern = srclines
+                expected = max(hunkstart + offset, 0)
+                for k, hline in enumerate(pattern):
+                    if expected + k >= len(lines):
+                        if check["eof"] is None:
+                            check["eof"] = hno
+                        break
+                    if stripped[expected + k] != hline:
+                        check["mismatch"].append((hno, expected + k + 1,
+                                                  hline,
+                                                  stripped[expected + k]))
+                        break
+                else:
+                    check["mismatch"].append((hno, expected + 1, b"", b""))
+                continue
+
+            offset = pos - skip - hunkstart
+            placed.append((hno, pos - skip + 1, offset, hunkfuzz))
+            spans.append((pos, core))
+            start = pos + len(pattern)
+
+        if check["mismatch"] or check["eof"] is not None:
+            # check if file matches hunk targets at their lines
+            for h in hunks:
+                if reverse:
+                    starttgt, tgtlines = h.startsrc, h.source_lines
+                else:
+                    starttgt, tgtlines = h.starttgt, h.target_lines
+                first = starttgt - 1 if tgtlines else 0
+                if tuple(stripped[first:first+len(tgtlines)]) != tgtlines:
+                    check["patched"] = False
+                    break
+        return spans
+
+    def _placed_lines(self, instream, spans, reverse=False, newline="auto"):
+        """ Generator that yields lines of `instream` patched with hunk
+            lines from `spans` returned by _place_hunks() for the same
+            content. Context lines are taken from the file, and line ends
+            of added lines are converted like in _patched_lines().
+        """
+        types = REVERSED_LINE_TYPES if reverse else LINE_TYPES
+        detect = newline == "auto"
+        newline = NEWLINES[newline]
+        reader = BlockReader(instream)
+
+        for at, text in spans:
+            for block in reader.lines(at - reader.lineno):
+                yield block
+            for hline in text:
+                kind = types[hline[0]]
+                if kind != INSERT:
+                    line = reader.readline()
+                    if kind == DELETE:
+                        continue
+                    # context lines keep line ends of the file
+                    if line.endswith((b"\n", b"\r")):
+                        yield line
+                        continue
+                    # last line without line end is taken from the hunk
+                if detect:
+                    # None if line ends of lines read so far are mixed
+                    newline = reader.newline()
+                if newline is None:
+                    yield hline[1:]
+                else:
+                    yield hline[1:].rstrip(b"\r\n") + newline
+        for block in reader.rest():
+            yield block
+
+    def patch_stream(self, instream, hunks, reverse=False, newline="auto"):
+        """ Generator that yields stream patched with hunks iterable,
+            or with reversed hunks if `reverse` is set. Unchanged parts
+            of stream are yielded in blocks of lines.
 
             Converts lineends in hunk lines to the best suitable format
-            autodetected from input
+            autodetected from input, or as set by `newline` policy like
+            in apply()
+        """
+        reader = BlockReader(instream)
+        for block in self._stream_hunks(reader, hunks, reverse, newline):
+            yield block
+        for block in reader.rest():
+            yield block
+
+    def _stream_hunks(self, reader, hunks, reverse=False, newline="auto"):
+        """ Generator that yields lines of BlockReader `reader` patched
+            with hunks up to the end of the last hunk
         """
 
         # todo: At the moment substituted lineends may not be the same
         #       at the start and at the end of patching. Also issue a
         #       warning/throw about mixed lineends (is it really needed?)
 
-        hunks = iter(hunks)
-
-        srclineno = 1
+        types = REVERSED_LINE_TYPES if reverse else LINE_TYPES
+        detect = newline == "auto"
+        newline = NEWLINES[newline]
 
-        lineends = {b'\n': 0, b'\r\n': 0, b'\r': 0}
-
-        def get_line():
-            """
-            local utility function - return line from source stream
-            collecting line end statistics on the way
-            """
-            line = instream.readline()
-            # 'U' mode works only with text files
-            if line.endswith(b"\r\n"):
-                lineends[b"\r\n"] += 1
-            elif line.endswith(b"\n"):
-                lineends[b"\n"] += 1
-            elif line.endswith(b"\r"):
-                lineends[b"\r"] += 1
-            return line
+        # number of the last line read, counting past the end of stream
+        srclineno = 0
 
         for hno, h in enumerate(hunks):
             debug("hunk %d" % (hno+1))
             # skip to line just before hunk starts
-            while srclineno < h.startsrc:
-                yield get_line()
-                srclineno += 1
-
+            startsrc = h.starttgt if reverse else h.startsrc
+            if srclineno + 1 < startsrc:
+                for block in reader.lines(startsrc - 1 - srclineno):
+                    yield block
+                srclineno = startsrc - 1
+
+            tgtlines = h.source_lines if reverse else h.target_lines
+            tgtidx = 0
             for hline in h.text:
+                kind = types[hline[0]]
                 # todo: check \ No newline at the end of file
-                if hline.startswith(b"-") or hline.startswith(b"\\"):
-                    get_line()
+                if kind == DELETE or kind == MARKER:
+                    reader.readline()
                     srclineno += 1
                     continue
                 else:
-                    if not hline.startswith(b"+"):
-                        get_line()
+                    if kind != INSERT:
+                        line = reader.readline()
                         srclineno += 1
-                    line2write = hline[1:]
-                    # detect if line ends are consistent in source file
-                    if sum([bool(lineends[x]) for x in lineends]) == 1:
-                        newline = [x for x in lineends if lineends[x] != 0][0]
-                        yield line2write.rstrip(b"\r\n")+newline
-                    else:  # newlines are mixed
-                        yield line2write
-
-        for line in instream:
-            yield line
-
-    def write_hunks(self, srcname, tgtname, hunks):
-        src = open(srcname, "rb")
-        tgt = open(tgtname, "wb")
-
+                        # context lines keep line ends of the file
+                        if line.endswith((b"\n", b"\r")):
+                            yield line
+                            tgtidx += 1
+                            continue
+                    if detect:
+                        # None if line ends are mixed in source file
+                        newline = reader.newline()
+                    if newline is not None:
+                        yield tgtlines[tgtidx] + newline
+                    else:
+                        yield hline[1:]
+                    tgtidx += 1
+
+    def write_hunks(self, srcname, tgtname, hunks, fsync=False,
+                    reverse=False, newline="auto"):
+        """ write `srcname` patched with `hunks` to `tgtname` through a
+            temporary file, so `tgtname` is replaced atomically and may
+            be the same as `srcname`. Permissions are copied from
+            `srcname`. With `fsync` data is flushed to disk first.
+            `reverse` applies hunks in reverse direction. `newline` is
+            the policy for line ends of added lines like in apply().
+        """
+        import shutil
+        if newline not in NEWLINES:
+            raise ValueError("newline must be one of %s, not %r"
+                             % (", ".join(NEWLINES), newline))
         debug("processing target file %s" % tgtname)
 
-        tgt.writelines(self.patch_stream(src, hunks))
-
-        tgt.close()
-        src.close()
-        # [ ] TODO: add test for permission copy
-        shutil.copymode(srcname, tgtname)
+        tgt, tmpname = self._tempfile(tgtname)
+        try:
+            with tgt, open(srcname, "rb") as src:
+                reader = BlockReader(src)
+                tgt.writelines(self._stream_hunks(reader, hunks, reverse,
+                                                  newline))
+                reader.copy_rest(tgt)
+                if fsync:
+                    tgt.flush()
+                    os.fsync(tgt.fileno())
+            shutil.copymode(srcname, tmpname)
+            os.replace(tmpname, tgtname)
+        except Exception:
+            os.unlink(tmpname)
+            raise
         return True
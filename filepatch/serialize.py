@@ -0,0 +1,320 @@
+""" Binary format of parsed PatchSet, written by PatchSet.dump() and
+    read by PatchSet.load().
+
+    All integers are little-endian, and every section starts at offset
+    aligned to 8 bytes. Hunk lines are kept in one contiguous data blob
+    at the end of file. When the file is memory-mapped, line offsets,
+    line types and line data of hunks reference the mapping and are
+    read only when they are accessed.
+
+    header          struct "<8sIIIIIIQQQQQQQII"
+        magic           b"FILEPTCH"
+        version         format version, 4
+        errors          PatchSet.errors
+        warnings        PatchSet.warnings
+        type            string index of PatchSet.type value or NONE
+        patches         number of patches
+        hunks           number of hunks
+        6 x u64         file offsets of sections below, in this order
+        size            u64 size of the dump including data
+        datachecksum    u32 CRC-32 of the data section
+        checksum        u32 CRC-32 of the dump up to the data section
+                        without this field
+
+    patches         one struct "<IIIIIIIIIIIIq" for each patch
+        source, target  string indexes or NONE
+        header          string index of the first header line
+        headerlines     number of header lines, which are consecutive
+        type            string index of Patch.type value or NONE
+        hunk            index of the first hunk of the patch
+        hunks           number of hunks
+        lf, crlf, cr    counts from Patch.hunkends
+        inserts, deletes, delta
+                        Patch counters, inserts is NONE if they are None
+
+    hunks           one struct "<IIIIIIQII" for each hunk
+        startsrc, linessrc, starttgt, linestgt
+        flags           bit 0 is Hunk.invalid
+        desc            string index of Hunk.desc
+        data            offset of hunk lines in data section
+        line            index of the first line in line types section
+        lines           number of lines
+
+    line offsets    u32 array, for each hunk `lines` + 1 offsets of hunk
+                    lines from hunk `data`, starting at index `line` +
+                    index of the hunk
+    line types      one byte for each line, see filepatch.hunk
+    strings         u32 number of strings, u32 array of string end
+                    offsets, followed by string data
+    data            hunk lines, empty context lines are stored without
+                    the leading space
+
+    load() checks the checksum and that all sections are within the
+    dump, so truncated or damaged files raise ValueError. The data
+    section is only checked for bounds, so it is not read from the
+    mapping, unless load() is asked to verify it with its checksum.
+"""
+
+import io
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+
+from filepatch.hunk import Hunk, HunkText
+from filepatch.patch import Patch
+from filepatch.patchset import PatchSetTypes
+
+MAGIC = b"FILEPTCH"
+VERSION = 4
+#: string index of missing value
+NONE = 0xffffffff
+
+HEADER = struct.Struct("<8sIIIIIIQQQQQQQII")
+PATCH = struct.Struct("<IIIIIIIIIIIIq")
+HUNK = struct.Struct("<IIIIIIQII")
+
+
+def _check(condition, what):
+    """ raise ValueError about damaged dump if `condition` is false """
+    if not condition:
+        raise ValueError("damaged PatchSet dump: %s" % what)
+
+
+def _u32array(view):
+    """ return u32 array from little-endian memoryview `view` without
+        copying it if possible
+    """
+    if sys.byteorder == "little":
+        return view.cast('I')
+    values = array('I')
+    values.frombytes(view)
+    values.byteswap()
+    return values
+
+
+def _u32bytes(values):
+    """ return little-endian bytes of u32 array `values` """
+    if sys.byteorder == "big":
+        values = array('I', values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def dump(patchset, fp):
+    """ write `patchset` to binary file object `fp` """
+    strings = []
+    stringidx = {}
+
+    def string(value):
+        if value is None:
+            return NONE
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        idx = stringidx.get(value)
+        if idx is None:
+            idx = stringidx[value] = len(strings)
+            strings.append(value)
+        return idx
+
+    patches = bytearray()
+    hunks = bytearray()
+    texts = []
+    lineoffsets = array('I')
+    linetypes = bytearray()
+    datasize = 0
+    for p in patchset.items:
+        header = len(strings)
+        # header lines are not deduplicated to keep them consecutive
+        for line in p.header:
+            strings.append(line)
+        ends = p.hunkends or {}
+        counted = p.inserts is not None
+        patches += PATCH.pack(
+            string(p.source), string(p.target), header, len(p.header),
+            string(p.type and p.type.value), len(hunks) // HUNK.size,
+            len(p.hunks), ends.get("lf", 0), ends.get("crlf", 0),
+            ends.get("cr", 0), p.inserts if counted else NONE,
+            p.deletes if counted else 0, p.delta if counted else 0)
+        for h in p.hunks:
+            text = h.text
+            if not isinstance(text, HunkText):
+                text = HunkText(text)
+            hunks += HUNK.pack(
+                h.startsrc, h.linessrc, h.starttgt, h.linestgt,
+                1 if h.invalid else 0, string(h.desc), datasize,
+                len(linetypes), len(text))
+            lineoffsets.extend(text.offsets)
+            linetypes += text.ops
+            texts.append(text)
+            datasize += text.offsets[-1]
+
+    pstype = string(patchset.type and patchset.type.value)
+    stringends = array('I')
+    end = 0
+    for value in strings:
+        end += len(value)
+        stringends.append(end)
+
+    sections = [bytes(patches), bytes(hunks), _u32bytes(lineoffsets),
+                bytes(linetypes),
+                struct.pack("<I", len(strings)) + _u32bytes(stringends) +
+                b"".join(strings)]
+    # parts of the dump after header, with padding of sections
+    parts = []
+    offsets = []
+    pos = HEADER.size
+    for section in sections:
+        parts.append(b"\0" * (-pos % 8))
+        pos += -pos % 8
+        offsets.append(pos)
+        parts.append(section)
+        pos += len(section)
+    parts.append(b"\0" * (-pos % 8))
+    pos += -pos % 8
+    offsets.append(pos)
+    # parts before data section are covered by checksum in the header
+    metaparts = len(parts)
+    datachecksum = 0
+    for text in texts:
+        base = text.base
+        part = memoryview(text.data)[base:base+text.offsets[-1]]
+        datachecksum = zlib.crc32(part, datachecksum)
+        parts.append(part)
+        pos += text.offsets[-1]
+
+    header = HEADER.pack(MAGIC, VERSION, patchset.errors, patchset.warnings,
+                         pstype, len(patchset.items), len(hunks) // HUNK.size,
+                         *offsets, pos, datachecksum, 0)[:-4]
+    checksum = zlib.crc32(header)
+    for part in parts[:metaparts]:
+        checksum = zlib.crc32(part, checksum)
+    fp.write(header)
+    fp.write(struct.pack("<I", checksum))
+    for part in parts:
+        fp.write(part)
+
+
+def load(fp, patchset, verify=False):
+    """ read patches written by dump() from binary file object `fp` to
+        empty `patchset`. The file is memory-mapped if it is possible.
+        With `verify` the checksum of hunk lines is checked too, which
+        reads all of them.
+    """
+    base = fp.tell()
+    try:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (io.UnsupportedOperation, ValueError, OSError):
+        data = fp.read()
+        base = 0
+    view = memoryview(data)
+
+    if len(data) < base + HEADER.size:
+        raise ValueError("truncated PatchSet dump")
+    (magic, version, errors, warnings, pstype, npatches, nhunks,
+     patchesoff, hunksoff, linesoff, typesoff, stringsoff, dataoff,
+     size, datachecksum, checksum) = HEADER.unpack_from(data, base)
+    if magic != MAGIC:
+        raise ValueError("not a PatchSet dump")
+    if version != VERSION:
+        raise ValueError("unsupported PatchSet dump version %d" % version)
+    if len(data) < base + size:
+        raise ValueError("truncated PatchSet dump")
+    _check(HEADER.size <= dataoff <= size and zlib.crc32(
+        view[base + HEADER.size:base + dataoff],
+        zlib.crc32(view[base:base + HEADER.size - 4])) == checksum,
+        "checksum mismatch")
+    if verify:
+        _check(zlib.crc32(view[base + dataoff:base + size]) == datachecksum,
+               "data checksum mismatch")
+
+    # sections are aligned and follow each other in the dump
+    offsets = [patchesoff, hunksoff, linesoff, typesoff, stringsoff,
+               dataoff, size]
+    _check(offsets[0] >= HEADER.size and
+           all(off % 8 == 0 for off in offsets[:-1]) and
+           all(a <= b for a, b in zip(offsets, offsets[1:])),
+           "invalid section offsets")
+    _check(npatches * PATCH.size <= hunksoff - patchesoff and
+           nhunks * HUNK.size <= linesoff - hunksoff, "too many records")
+
+    _check(stringsoff + 4 <= dataoff, "strings out of bounds")
+    nstrings = struct.unpack_from("<I", data, base + stringsoff)[0]
+    start = base + stringsoff + 4
+    _check(4 * nstrings <= base + dataoff - start, "strings out of bounds")
+    ends = _u32array(view[start:start + 4 * nstrings])
+    start += 4 * nstrings
+    limit = base + dataoff - start
+    strings = []
+    prev = 0
+    for end in ends:
+        _check(prev <= end <= limit, "strings out of bounds")
+        strings.append(bytes(view[start + prev:start + end]))
+        prev = end
+
+    def string(idx):
+        if idx == NONE:
+            return None
+        _check(idx < nstrings, "invalid string index")
+        return strings[idx]
+
+    def settype(idx):
+        return None if idx == NONE else PatchSetTypes(
+            string(idx).decode())
+
+    hunkrecords = [HUNK.unpack_from(data, base + hunksoff + i * HUNK.size)
+                   for i in range(nhunks)]
+    # lines and data of hunks are consecutive
+    nlines = 0
+    for record in hunkrecords:
+        _check(record[7] == nlines, "invalid hunk lines")
+        nlines += record[8]
+    _check(4 * (nlines + nhunks) <= typesoff - linesoff and
+           nlines <= stringsoff - typesoff, "hunk lines out of bounds")
+    lineoffsets = _u32array(view[base + linesoff:
+                                 base + linesoff + 4 * (nlines + nhunks)])
+    linetypes = view[base + typesoff:base + typesoff + nlines]
+
+    hunks = []
+    datasize = 0
+    for i, (startsrc, linessrc, starttgt, linestgt, flags, desc, hunkdata,
+            line, lines) in enumerate(hunkrecords):
+        hunkoffsets = lineoffsets[line + i:line + i + lines + 1]
+        _check(hunkdata == datasize and hunkoffsets[0] == 0,
+               "invalid hunk data")
+        datasize += hunkoffsets[-1]
+        h = Hunk()
+        h.startsrc = startsrc
+        h.linessrc = linessrc
+        h.starttgt = starttgt
+        h.linestgt = linestgt
+        h.invalid = bool(flags & 1)
+        h.desc = string(desc)
+        h.text = HunkText.fromparts(
+            data, hunkoffsets, linetypes[line:line + lines],
+            base + dataoff + hunkdata)
+        hunks.append(h)
+    _check(datasize <= size - dataoff, "hunk data out of bounds")
+
+    patchset.errors = errors
+    patchset.warnings = warnings
+    patchset.type = settype(pstype)
+    for i in range(npatches):
+        (source, target, header, headerlines, ptype, hunk, count, lf, crlf,
+         cr, inserts, deletes, delta) = PATCH.unpack_from(
+            data, base + patchesoff + i * PATCH.size)
+        _check(hunk + count <= nhunks and
+               header + headerlines <= nstrings, "invalid patch")
+        p = Patch()
+        p.source = string(source)
+        p.target = string(target)
+        p.header = strings[header:header + headerlines]
+        p.type = settype(ptype)
+        p.hunks = hunks[hunk:hunk + count]
+        p.hunkends = dict(lf=lf, crlf=crlf, cr=cr)
+        if inserts != NONE:
+            p.inserts = inserts
+            p.deletes = deletes
+            p.delta = delta
+        patchset.items.append(p)
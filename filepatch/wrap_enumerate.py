@@ -39,3 +39,130 @@ class WrapEnumerate(enumerate):
     @property
     def lineno(self):
         return self._lineno
+
+    def wait(self):
+        """Generator used with `yield from` by the parser when next()
+           returns False. The end of this stream is final, so it returns
+           False without yielding."""
+        return False
+        yield
+
+
+class LineFeed(object):
+    """Line source with the same interface as WrapEnumerate, which is
+    filled with chunks of data by feed() instead of reading them from
+    a stream. Lines are split at b"\\n" like lines of a binary file.
+
+    When all fed lines are read, next() returns False but the stream is
+    not empty until close() is called. The parser then waits for more
+    data in wait(), which yields None to its caller.
+    """
+
+    def __init__(self):
+        self._buf = b''
+        self._pos = 0
+        self._closed = False
+        self._exhausted = False
+        self._lineno = -1
+        self._line = False
+
+    def feed(self, data):
+        """Add chunk of `data` to the stream."""
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+
+    def close(self):
+        """Mark the end of stream. Data after the last b"\\n" becomes
+           the last line."""
+        self._closed = True
+
+    def next(self):
+        """Read the next line and return True if it is available."""
+        if self._exhausted:
+            return False
+        buf = self._buf
+        pos = self._pos
+        end = buf.find(b'\n', pos) + 1
+        if not end:
+            if not self._closed:
+                self._line = False
+                return False
+            end = len(buf)
+            if end == pos:
+                self._exhausted = True
+                self._line = False
+                return False
+        self._line = buf[pos:end]
+        self._pos = end
+        self._lineno += 1
+        return True
+
+    def wait(self):
+        """Yield None until the next line is fed and return True, or
+           return False at the end of stream."""
+        while not self._exhausted:
+            yield None
+            if self.next():
+                return True
+        return False
+
+    @property
+    def is_empty(self):
+        return self._exhausted
+
+    @property
+    def line(self):
+        return self._line
+
+    @property
+    def lineno(self):
+        return self._lineno
+
+
+class MappedLines(object):
+    """Line source with the same interface as WrapEnumerate, which reads
+    lines from mmap `mapping` and can skip() over a block of lines
+    without reading them.
+    """
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+        self._exhausted = False
+        self._lineno = -1
+        self._line = False
+
+    def next(self):
+        """Read the next line and return True if it is available."""
+        if self._exhausted:
+            return False
+        line = self._mapping.readline()
+        if not line:
+            self._exhausted = True
+            self._line = False
+            return False
+        self._line = line
+        self._lineno += 1
+        return True
+
+    def skip(self, pos, lines):
+        """Continue reading at `pos` of the mapping, which is the end of
+           `lines` lines following the current line."""
+        self._mapping.seek(pos)
+        self._lineno += lines
+
+    def wait(self):
+        """The end of mapping is final, return False like WrapEnumerate."""
+        return False
+        yield
+
+    @property
+    def is_empty(self):
+        return self._exhausted
+
+    @property
+    def line(self):
+        return self._line
+
+    @property
+    def lineno(self):
+        return self._lineno
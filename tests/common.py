@@ -0,0 +1,43 @@
+from os.path import join, dirname, abspath
+
+from filepatch import PatchSet
+
+TESTS = dirname(abspath(__file__))
+TESTDATA = join(TESTS, 'data')
+
+#: patches relative to TESTS that are parsed in different ways and compared
+FIXTURES = ["01uni_multi/01uni_multi.patch",
+            "data/git-changed-2-files.diff",
+            "data/autofix/stripped-trailing-whitespace.diff",
+            "data/failing/missing-hunk-line.diff"]
+
+
+def testfile(name):
+    return join(TESTDATA, name)
+
+
+def parsed(name, **options):
+    """ return (PatchSet, parse() result) for patch `name` relative to
+        TESTS parsed with `options`
+    """
+    patchset = PatchSet()
+    with open(join(TESTS, name), "rb") as fp:
+        return patchset, patchset.parse(fp, **options)
+
+
+def comparable(patchset, hunks=True, stats=True):
+    """ return comparable structure of parsed `patchset`, without hunks
+        or Patch counters of inserted and deleted lines if `hunks` or
+        `stats` are not set
+    """
+    patches = []
+    for p in patchset.items:
+        fields = [p.source, p.target, p.header, p.hunkends, p.type]
+        if stats:
+            fields += [p.inserts, p.deletes, p.delta]
+        if hunks:
+            fields.append([(h.startsrc, h.linessrc, h.starttgt, h.linestgt,
+                            h.invalid, h.desc, list(h.text))
+                           for h in p.hunks])
+        patches.append(tuple(fields))
+    return (patchset.type, patchset.errors, patchset.warnings, patches)
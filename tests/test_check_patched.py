@@ -44,3 +44,33 @@ class TestCheckPatched(unittest.TestCase):
             self):
         pto2 = fromfile("04can_patch.patch")
         self.assertFalse(pto2.can_patch("04can_patch.to"))
+
+    def test_can_patch_many(self):
+        pto = fromfile("01uni_multi/01uni_multi.patch")
+        os.chdir(join(TESTS, "01uni_multi", "[result]"))
+        names = [b"updatedlg.cpp", "updatedlg.h", b"missing.cpp"]
+        self.assertEqual(pto.can_patch_many(names), [True, True, None])
+        self.assertEqual(pto.can_patch_many(names, workers=2),
+                         [True, True, None])
+        # index follows current directory and changes of items
+        os.chdir(join(TESTS, "01uni_multi"))
+        self.assertEqual(pto.can_patch_many(names), [False, False, None])
+        pto.items[0].source = b"renamed.cpp"
+        self.assertEqual(pto.can_patch(b"updatedlg.cpp"), None)
+
+    def test_can_patch_index_reused(self):
+        pto = fromfile("01uni_multi/01uni_multi.patch")
+        os.chdir(join(TESTS, "01uni_multi", "[result]"))
+        pto.can_patch(b"updatedlg.cpp")
+        index = pto._index(sources=True)
+        for name in [b"updatedlg.cpp", "missing.cpp"]:
+            pto.can_patch(name)
+        pto.can_patch_many([b"updatedlg.h"])
+        self.assertIs(pto._index(sources=True), index)
+        # a new directory or a renamed patch rebuilds it
+        os.chdir(join(TESTS, "01uni_multi"))
+        self.assertIsNot(pto._index(sources=True), index)
+        index = pto._index(sources=True)
+        pto.items[1].source = b"renamed.h"
+        self.assertIsNot(pto._index(sources=True), index)
+        self.assertIsNone(pto.can_patch(b"updatedlg.h"))
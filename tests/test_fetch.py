@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import unittest
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from urllib.error import HTTPError, URLError
+
+from filepatch import fromfile, fromurl, fromurl_async, fromurls, PatchSet
+from tests.common import TESTS, comparable
+
+
+class Handler(SimpleHTTPRequestHandler):
+    """ serves files from tests directory, /chunked/ prefix sends them
+        with chunked transfer encoding and /redirect/ redirects to them
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/redirect"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path.startswith("/chunked/"):
+            with open(join(TESTS, self.path[len("/chunked/"):]), "rb") as f:
+                data = f.read()
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(data), 100):
+                chunk = data[i:i+100]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(Handler, directory=TESTS))
+        cls.server.connections = 0
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+        cls.url = "http://127.0.0.1:%d/" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+
+    def test_fromurl(self):
+        name = "01uni_multi/01uni_multi.patch"
+        self.assertEqual(comparable(fromurl(self.url + name)),
+                         comparable(fromfile(join(TESTS, name))))
+
+    def test_fromurl_async(self):
+        names = ["01uni_multi/01uni_multi.patch",
+                 "data/git-changed-2-files.diff",
+                 "data/git-changed-file.diff"]
+        urls = [self.url + prefix + name
+                for prefix in ["", "chunked/", "redirect/"]
+                for name in names]
+
+        async def fetch():
+            return await asyncio.gather(*[fromurl_async(url) for url in urls])
+
+        for i, ps in enumerate(asyncio.run(fetch())):
+            name = names[i % len(names)]
+            self.assertEqual(comparable(ps),
+                             comparable(fromfile(join(TESTS, name))))
+
+    def test_fromurl_async_errors(self):
+        self.assertFalse(asyncio.run(fromurl_async(
+            self.url + "data/failing/not-a-patch.log")))
+        with self.assertRaises(HTTPError) as cm:
+            asyncio.run(fromurl_async(self.url + "missing.diff"))
+        self.assertEqual(cm.exception.code, 404)
+
+    def test_fromurls(self):
+        names = ["01uni_multi/01uni_multi.patch",
+                 "data/git-changed-2-files.diff",
+                 "data/git-changed-file.diff"]
+        urls = [self.url + prefix + name
+                for prefix in ["", "chunked/", "redirect/"]
+                for name in names]
+        connections = self.server.connections
+        results = fromurls(urls, max_workers=2)
+        # keep-alive connections are reused
+        self.assertLessEqual(self.server.connections - connections, 2)
+        self.assertEqual(len(results), len(urls))
+        for i, ps in enumerate(results):
+            name = names[i % len(names)]
+            self.assertEqual(comparable(ps),
+                             comparable(fromfile(join(TESTS, name))))
+
+    def test_fromurls_errors(self):
+        results = fromurls([self.url + "missing.diff",
+                            self.url + "data/failing/not-a-patch.log",
+                            "ftp://localhost/a.diff",
+                            self.url + "data/git-changed-file.diff"])
+        self.assertIsInstance(results[0], HTTPError)
+        self.assertEqual(results[0].code, 404)
+        self.assertIs(results[1], False)
+        self.assertIsInstance(results[2], URLError)
+        self.assertIsInstance(results[3], PatchSet)
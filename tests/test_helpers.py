@@ -1,5 +1,7 @@
 import unittest
+from io import BytesIO
 
+from filepatch.blockreader import BlockReader
 from filepatch.utils import xisabs, xnormpath, pathstrip, xstrip
 
 
@@ -34,3 +36,22 @@ class TestHelpers(unittest.TestCase):
             pathstrip(b'path/to/test/name.diff', 2), b'test/name.diff')
         self.assertEqual(pathstrip(b'path/name.diff', 1), b'name.diff')
         self.assertEqual(pathstrip(b'path/name.diff', 0), b'path/name.diff')
+
+    def test_block_reader(self):
+        data = b"a\r\nb\r\nc\r\nlong line\r\nd\r\ne"
+        for blocksize in (1, 3, 64):
+            reader = BlockReader(BytesIO(data), blocksize)
+            self.assertEqual(reader.readline(), b"a\r\n")
+            self.assertEqual(b"".join(reader.lines(3)),
+                             b"b\r\nc\r\nlong line\r\n")
+            self.assertEqual(reader.newline(), b"\r\n")
+            self.assertEqual(b"".join(reader.lines(5)), b"d\r\ne")
+            self.assertEqual(reader.lineno, 6)
+            self.assertEqual(reader.readline(), b"")
+            self.assertEqual((reader.lf, reader.crlf, reader.cr), (0, 5, 0))
+
+        reader = BlockReader(BytesIO(data), 4)
+        reader.readline()
+        out = BytesIO()
+        reader.copy_rest(out)
+        self.assertEqual(out.getvalue(), data[3:])
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+import unittest
+
+# modules that are slow to import and must not be loaded by
+# `import filepatch` and the command line tool before they are used
+SLOW_MODULES = ["pkg_resources", "importlib.metadata", "urllib.request",
+                "http.client", "asyncio", "concurrent.futures", "tempfile",
+                "shutil", "hashlib", "filepatch.cache", "filepatch.fetch",
+                "filepatch.serialize"]
+
+
+def imported(code):
+    """ return modules imported by running `code` in a new interpreter """
+    out = subprocess.check_output(
+        [sys.executable, "-c",
+         "import sys; before = set(sys.modules); %s; "
+         "print('\\n'.join(set(sys.modules) - before))" % code],
+        universal_newlines=True)
+    return set(out.split())
+
+
+class TestImport(unittest.TestCase):
+    def test_lazy_imports(self):
+        for code in ["import filepatch",
+                     "import filepatch.__main__",
+                     "import filepatch; filepatch.fromstring("
+                     "b'--- a\\n+++ a\\n@@ -1 +1 @@\\n-a\\n+b\\n')"]:
+            self.assertEqual(imported(code) & set(SLOW_MODULES), set(),
+                             code)
+
+    def test_lazy_attributes(self):
+        import filepatch
+        from filepatch.cache import PatchCache
+        self.assertIs(filepatch.PatchCache, PatchCache)
+        self.assertIsInstance(filepatch.__version__, str)
+        with self.assertRaises(AttributeError):
+            filepatch.missing
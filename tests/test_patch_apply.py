@@ -1,16 +1,22 @@
 import os
 import shutil
 import unittest
+from unittest import mock
 from os import getcwd
 from os.path import dirname, abspath, join
 from tempfile import mkdtemp
 
-from filepatch import fromfile
+from filepatch import fromfile, fromstring, PatchSet
 
 
 TESTS = dirname(abspath(__file__))
 
 
+def get_file_content(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
 class TestPatchApply(unittest.TestCase):
     def setUp(self):
         self.save_cwd = getcwd()
@@ -38,11 +44,170 @@ class TestPatchApply(unittest.TestCase):
         pto = fromfile('03trail_fname.patch')
         self.assertTrue(pto.apply())
 
-    def test_revert(self):
-        def get_file_content(filename):
-            with open(filename, 'rb') as f:
-                return f.read()
+    def test_apply_reads_source_once(self):
+        self.tmpcopy(['03trail_fname.patch',
+                      '03trail_fname.from'])
+        pto = fromfile('03trail_fname.patch')
+        opened = []
+
+        def logged_open(name, mode='r', *args, **kwargs):
+            opened.append((name, mode))
+            return open(name, mode, *args, **kwargs)
+
+        with mock.patch('filepatch.patchset.open', logged_open, create=True):
+            self.assertTrue(pto.apply())
+            self.assertEqual(opened, [(b'03trail_fname.from', 'rb')])
+            # already patched file is detected in the same pass
+            with self.assertLogs('filepatch', level='WARNING') as log:
+                self.assertFalse(pto.apply())
+            self.assertEqual(len(opened), 2)
+        self.assertIn('already patched', log.output[-1])
+
+    def test_apply_error_removes_tempfile(self):
+        with open('insert.txt', 'wb') as f:
+            f.write(b"1\n2\n3\n")
+        pto = fromstring(b"--- insert.txt\n+++ insert.txt\n"
+                         b"@@ -2,0 +3,2 @@\n+a\n+b\n")
+
+        def denied_open(name, mode='r', *args, **kwargs):
+            if mode == 'rb':
+                raise PermissionError("denied")
+            return open(name, mode, *args, **kwargs)
+
+        with mock.patch('filepatch.patchset.open', denied_open, create=True):
+            with self.assertRaises(PermissionError):
+                pto.apply()
+        self.assertEqual(os.listdir('.'), ['insert.txt'])
+
+    def test_apply_insert_only_hunk(self):
+        with open('insert.txt', 'wb') as f:
+            f.write(b"1\n2\n3\n")
+        pto = fromstring(b"--- insert.txt\n+++ insert.txt\n"
+                         b"@@ -2,0 +3,2 @@\n+a\n+b\n")
+        self.assertTrue(pto.apply())
+        self.assertEqual(get_file_content('insert.txt'),
+                         b"1\n2\na\nb\n3\n")
+
+    def test_apply_offset(self):
+        with open('offset.txt', 'wb') as f:
+            f.write(b"0\n0\n1\n2\n3\n4\n5\n6\n")
+        pto = fromstring(b"--- offset.txt\n+++ offset.txt\n"
+                         b"@@ -1,3 +1,3 @@\n 1\n-2\n+two\n 3\n"
+                         b"@@ -4,2 +4,2 @@\n-4\n+four\n 5\n")
+        self.assertFalse(pto.apply())
+        with self.assertLogs('filepatch', level='INFO') as log:
+            self.assertTrue(pto.apply(fuzz=0))
+        self.assertEqual(get_file_content('offset.txt'),
+                         b"0\n0\n1\ntwo\n3\nfour\n5\n6\n")
+        self.assertIn(" hunk no.1 applied at line 3 (offset 2 lines, fuzz 0)",
+                      [r.getMessage() for r in log.records])
+        self.assertIn(" hunk no.2 applied at line 6 (offset 2 lines, fuzz 0)",
+                      [r.getMessage() for r in log.records])
+
+    def test_apply_fuzz(self):
+        with open('fuzz.txt', 'wb') as f:
+            f.write(b"a\nb\nc\r\nd\ne\nf\n")
+        pto = fromstring(b"--- fuzz.txt\n+++ fuzz.txt\n"
+                         b"@@ -1,5 +1,5 @@\n x\n b\n-c\n+C\n d\n y\n")
+        self.assertFalse(pto.apply(fuzz=0))
+        with self.assertLogs('filepatch', level='INFO') as log:
+            self.assertTrue(pto.apply(fuzz=1))
+        # context lines are kept from the file
+        self.assertEqual(get_file_content('fuzz.txt'),
+                         b"a\nb\nC\nd\ne\nf\n")
+        self.assertIn(" hunk no.1 applied at line 1 (offset 0 lines, fuzz 1)",
+                      [r.getMessage() for r in log.records])
+
+    def test_apply_fuzz_error_removes_tempfile(self):
+        with open('fuzz.txt', 'wb') as f:
+            f.write(b"a\nb\nc\nd\n")
+        pto = fromstring(b"--- fuzz.txt\n+++ fuzz.txt\n"
+                         b"@@ -2,2 +2,2 @@\n b\n-c\n+C\n")
+        for transactional in [False, True]:
+            with mock.patch.object(PatchSet, '_place_hunks',
+                                   side_effect=MemoryError):
+                with self.assertRaises(MemoryError):
+                    pto.apply(fuzz=1, transactional=transactional)
+            self.assertEqual(os.listdir('.'), ['fuzz.txt'])
+        self.assertEqual(get_file_content('fuzz.txt'), b"a\nb\nc\nd\n")
+
+    def test_apply_fuzz_nearest(self):
+        with open('nearest.txt', 'wb') as f:
+            f.write(b"x\ny\n" * 5)
+        pto = fromstring(b"--- nearest.txt\n+++ nearest.txt\n"
+                         b"@@ -6,2 +6,2 @@\n-x\n+z\n y\n")
+        self.assertTrue(pto.apply(fuzz=0))
+        self.assertEqual(get_file_content('nearest.txt'),
+                         b"x\ny\nx\ny\nz\ny\nx\ny\nx\ny\n")
+
+    def test_apply_newline(self):
+        patch = (b"--- newline.txt\n+++ newline.txt\n"
+                 b"@@ -1,2 +1,3 @@\n a\n+b\r\n c\n")
+        expected = {"auto": b"a\nb\nc\n",
+                    "preserve": b"a\nb\r\nc\n",
+                    "lf": b"a\nb\nc\n",
+                    "crlf": b"a\nb\r\nc\n"}
+        for newline, content in expected.items():
+            with open('newline.txt', 'wb') as f:
+                f.write(b"a\nc\n")
+            pto = fromstring(patch)
+            self.assertTrue(pto.apply(newline=newline))
+            self.assertEqual(get_file_content('newline.txt'), content,
+                             newline)
+            pto.write_hunks('newline.txt', 'reverted.txt',
+                            pto.items[0].hunks, reverse=True, newline="crlf")
+            self.assertEqual(get_file_content('reverted.txt'), b"a\nc\n")
+        self.assertRaises(ValueError, pto.apply, newline="cr")
+
+    def test_apply_newline_fuzz(self):
+        # line ends are consistent only before the added line
+        source = b"a\nb\nc\r\nd\r\n"
+        pto = fromstring(b"--- newline.txt\n+++ newline.txt\n"
+                         b"@@ -1,2 +1,3 @@\n a\n+x\r\n b\n")
+        results = []
+        for fuzz in [None, 0, 1]:
+            with open('newline.txt', 'wb') as f:
+                f.write(source)
+            self.assertTrue(pto.apply(fuzz=fuzz))
+            results.append(get_file_content('newline.txt'))
+        self.assertEqual(results, [b"a\nx\nb\nc\r\nd\r\n"] * 3)
+
+    def test_apply_newline_context(self):
+        # the policy applies to added lines only
+        pto = fromstring(b"--- newline.txt\n+++ newline.txt\n"
+                         b"@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n")
+        expected = {"lf": b"a\r\nB\nc\r\nd\r\n",
+                    "preserve": b"a\r\nB\nc\r\nd\r\n",
+                    "crlf": b"a\r\nB\r\nc\r\nd\r\n"}
+        for newline, content in expected.items():
+            for fuzz in [None, 0]:
+                with open('newline.txt', 'wb') as f:
+                    f.write(b"a\r\nb\r\nc\r\nd\r\n")
+                self.assertTrue(pto.apply(fuzz=fuzz, newline=newline))
+                self.assertEqual(get_file_content('newline.txt'), content,
+                                 (newline, fuzz))
+
+    def test_apply_keeps_mode(self):
+        self.tmpcopy(['03trail_fname.patch',
+                      '03trail_fname.from'])
+        os.chmod('03trail_fname.from', 0o754)
+        pto = fromfile('03trail_fname.patch')
+        self.assertTrue(pto.apply(fsync=True))
+        self.assertEqual(os.stat('03trail_fname.from').st_mode & 0o777,
+                         0o754)
+        self.assertEqual(sorted(os.listdir('.')),
+                         ['03trail_fname.from', '03trail_fname.patch'])
+
+    def test_write_hunks_in_place(self):
+        self.tmpcopy(['03trail_fname.patch',
+                      '03trail_fname.from'])
+        pto = fromfile('03trail_fname.patch')
+        pto.write_hunks('03trail_fname.from', '03trail_fname.from',
+                        pto.items[0].hunks)
+        self.assertEqual(get_file_content('03trail_fname.from'),
+                         get_file_content(join(TESTS, '03trail_fname.to')))
 
+    def test_revert(self):
         self.tmpcopy(['03trail_fname.patch',
                       '03trail_fname.from'])
         pto = fromfile('03trail_fname.patch')
@@ -55,6 +220,156 @@ class TestPatchApply(unittest.TestCase):
             get_file_content(self.tmpdir + '/03trail_fname.from'),
             get_file_content(TESTS + '/03trail_fname.from'))
 
+    def test_revert_mapped(self):
+        self.tmpcopy(['03trail_fname.patch',
+                      '03trail_fname.from'])
+        pto = fromfile('03trail_fname.patch', mapped=True)
+        self.assertTrue(pto.apply())
+        self.assertTrue(pto.revert())
+        with open('03trail_fname.from', 'rb') as f:
+            with open(join(TESTS, '03trail_fname.from'), 'rb') as f2:
+                self.assertEqual(f.read(), f2.read())
+
+    def test_revert_keeps_hunks(self):
+        self.tmpcopy(['03trail_fname.patch',
+                      '03trail_fname.to'])
+        pto = fromfile('03trail_fname.patch')
+        hunk = pto.items[0].hunks[0]
+        text = hunk.text
+        pto.write_hunks('03trail_fname.to', '03trail_fname.from',
+                        pto.items[0].hunks, reverse=True)
+        self.assertEqual(get_file_content('03trail_fname.from'),
+                         get_file_content(join(TESTS, '03trail_fname.from')))
+        self.assertTrue(pto.apply())
+        self.assertTrue(pto.revert(fuzz=0))
+        self.assertEqual(get_file_content('03trail_fname.from'),
+                         get_file_content(join(TESTS, '03trail_fname.from')))
+        # hunks are read in reverse direction and are not copied
+        self.assertIs(pto.items[0].hunks[0], hunk)
+        self.assertIs(hunk.text, text)
+        self.assertEqual((hunk.startsrc, hunk.linessrc), (1, 7))
+
+    def _apply_logged(self, workers):
+        treeroot = join(self.tmpdir, 'tree%s' % workers)
+        shutil.copytree(join(TESTS, '01uni_multi'), treeroot)
+        pto = fromfile(join(TESTS, '01uni_multi/01uni_multi.patch'))
+        with self.assertLogs('filepatch', level='DEBUG') as log:
+            self.assertTrue(pto.apply(root=treeroot, workers=workers))
+        for name in ['updatedlg.cpp', 'updatedlg.h', 'conf.h']:
+            self.assertEqual(
+                get_file_content(join(treeroot, name)),
+                get_file_content(join(TESTS, '01uni_multi/[result]', name)))
+        return log.output
+
+    def test_apply_parallel(self):
+        self.assertEqual(self._apply_logged(workers=4),
+                         self._apply_logged(workers=None))
+
+    def test_apply_parallel_same_file(self):
+        self.tmpcopy(['03trail_fname.from'])
+        pto = fromstring(
+            b"--- 03trail_fname.from\n+++ 03trail_fname.from\n"
+            b"@@ -1,3 +1,3 @@\n Tests:\n-- file not found\n+- not found\n"
+            b" - trailing spaces in patch filenames\n"
+            b"--- 03trail_fname.from\n+++ 03trail_fname.from\n"
+            b"@@ -1,3 +1,3 @@\n-Tests:\n+Tests\n - not found\n"
+            b" - trailing spaces in patch filenames\n")
+        self.assertTrue(pto.apply(workers=2))
+        self.assertTrue(get_file_content('03trail_fname.from').startswith(
+            b"Tests\r\n- not found\r\n"))
+
+    def test_apply_transactional(self):
+        treeroot = join(self.tmpdir, 'tree')
+        shutil.copytree(join(TESTS, '01uni_multi'), treeroot)
+        entries = sorted(os.listdir(treeroot))
+        pto = fromfile(join(TESTS, '01uni_multi/01uni_multi.patch'))
+        self.assertTrue(pto.apply(root=treeroot, workers=2,
+                                  transactional=True))
+        for name in ['updatedlg.cpp', 'updatedlg.h', 'conf.h']:
+            self.assertEqual(
+                get_file_content(join(treeroot, name)),
+                get_file_content(join(TESTS, '01uni_multi/[result]', name)))
+        self.assertEqual(sorted(os.listdir(treeroot)), entries)
+
+    def test_apply_transactional_same_file(self):
+        self.tmpcopy(['03trail_fname.from'])
+        pto = fromstring(
+            b"--- 03trail_fname.from\n+++ 03trail_fname.from\n"
+            b"@@ -1,3 +1,3 @@\n Tests:\n-- file not found\n+- not found\n"
+            b" - trailing spaces in patch filenames\n"
+            b"--- 03trail_fname.from\n+++ 03trail_fname.from\n"
+            b"@@ -1,3 +1,3 @@\n-Tests:\n+Tests\n - not found\n"
+            b" - trailing spaces in patch filenames\n")
+        self.assertTrue(pto.apply(transactional=True))
+        self.assertTrue(get_file_content('03trail_fname.from').startswith(
+            b"Tests\r\n- not found\r\n"))
+        self.assertEqual(os.listdir('.'), ['03trail_fname.from'])
+
+    def test_apply_transactional_failure(self):
+        treeroot = join(self.tmpdir, 'tree')
+        shutil.copytree(join(TESTS, '01uni_multi'), treeroot)
+        # the last file in patch is different
+        shutil.copy(join(TESTS, '01uni_multi/[result]/conf.h'), treeroot)
+        entries = sorted(os.listdir(treeroot))
+        pto = fromfile(join(TESTS, '01uni_multi/01uni_multi.patch'))
+        self.assertFalse(pto.apply(root=treeroot, transactional=True))
+        self.assertEqual(
+            get_file_content(join(treeroot, 'updatedlg.cpp')),
+            get_file_content(join(TESTS, '01uni_multi/updatedlg.cpp')))
+        self.assertEqual(sorted(os.listdir(treeroot)), entries)
+
+    def test_apply_transactional_rollback(self):
+        treeroot = join(self.tmpdir, 'tree')
+        shutil.copytree(join(TESTS, '01uni_multi'), treeroot)
+        entries = sorted(os.listdir(treeroot))
+        pto = fromfile(join(TESTS, '01uni_multi/01uni_multi.patch'))
+        replace = os.replace
+        calls = []
+
+        def failing_replace(src, dst):
+            calls.append(dst)
+            if len(calls) == 3:
+                raise OSError("disk full")
+            replace(src, dst)
+
+        with mock.patch('os.replace', failing_replace):
+            self.assertFalse(pto.apply(root=treeroot, transactional=True))
+        for name in ['updatedlg.cpp', 'updatedlg.h', 'conf.h']:
+            self.assertEqual(
+                get_file_content(join(treeroot, name)),
+                get_file_content(join(TESTS, '01uni_multi', name)))
+        self.assertEqual(sorted(os.listdir(treeroot)), entries)
+
+    def test_apply_transactional_error(self):
+        treeroot = join(self.tmpdir, 'tree')
+        shutil.copytree(join(TESTS, '01uni_multi'), treeroot)
+        entries = sorted(os.listdir(treeroot))
+        pto = fromfile(join(TESTS, '01uni_multi/01uni_multi.patch'))
+        patch_file = PatchSet._patch_file
+
+        def failing_patch_file(self, i, total, p, filename, *args):
+            if filename.endswith(b'updatedlg.h'):
+                raise OSError("read error")
+            return patch_file(self, i, total, p, filename, *args)
+
+        cwd = os.getcwd()
+        for workers in [None, 2]:
+            with mock.patch.object(PatchSet, '_patch_file',
+                                   failing_patch_file):
+                with self.assertRaises(OSError):
+                    pto.apply(root=treeroot, workers=workers,
+                              transactional=True)
+            self.assertEqual(os.getcwd(), cwd)
+            self.assertEqual(sorted(os.listdir(treeroot)), entries)
+            self.assertEqual(
+                get_file_content(join(treeroot, 'updatedlg.cpp')),
+                get_file_content(join(TESTS, '01uni_multi/updatedlg.cpp')))
+        # the same for errors of files applied one by one
+        with mock.patch.object(PatchSet, '_patch_file', failing_patch_file):
+            with self.assertRaises(OSError):
+                pto.apply(root=treeroot)
+        self.assertEqual(os.getcwd(), cwd)
+
     def test_apply_root(self):
         treeroot = join(self.tmpdir, 'rootparent')
         shutil.copytree(join(TESTS, '06nested'), treeroot)
@@ -0,0 +1,90 @@
+import os
+import shutil
+import unittest
+from unittest import mock
+from os.path import join
+from tempfile import mkdtemp
+
+from filepatch import fromfile, fromstring, PatchCache, PatchSet
+from tests.common import TESTS, comparable
+
+
+class TestPatchCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix=self.__class__.__name__)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fromfile_cached(self):
+        cache = PatchCache(join(self.tmpdir, 'cache'))
+        patchfile = join(TESTS, 'data/autofix',
+                         'stripped-trailing-whitespace.diff')
+        parsed = fromfile(patchfile, cache=cache)
+        self.assertEqual(len(cache.keys()), 1)
+        with mock.patch.object(PatchSet, 'parse') as parse:
+            cached = fromfile(patchfile, cache=cache)
+        parse.assert_not_called()
+        self.assertEqual(comparable(cached), comparable(parsed))
+        self.assertEqual(comparable(cached),
+                         comparable(fromfile(patchfile)))
+
+    def test_fromstring_cached(self):
+        cache = PatchCache(join(self.tmpdir, 'cache'))
+        with open(join(TESTS, '01uni_multi/01uni_multi.patch'), 'rb') as f:
+            data = f.read()
+        parsed = fromstring(data, cache=cache)
+        self.assertEqual(comparable(fromstring(data, cache=cache)),
+                         comparable(parsed))
+        self.assertFalse(fromstring(b"--- a\n+++ b\n@@ -1 +1 @@\n-a\n",
+                                    cache=cache))
+        self.assertEqual(len(cache.keys()), 1)
+
+    def test_eviction(self):
+        cache = PatchCache(join(self.tmpdir, 'cache'))
+        patches = [b"--- a\n+++ a\n@@ -1 +1 @@\n-%d\n+%d\n" % (i, i + 1)
+                   for i in range(3)]
+        fromstring(patches[0], cache=cache)
+        size = os.path.getsize(cache._path(cache.key(patches[0])))
+        cache.maxsize = size * 2
+        fromstring(patches[1], cache=cache)
+        # the first entry is used most recently
+        os.utime(cache._path(cache.key(patches[1])), ns=(0, 0))
+        fromstring(patches[0], cache=cache)
+        fromstring(patches[2], cache=cache)
+        self.assertEqual(sorted(cache.keys()),
+                         sorted([cache.key(patches[0]),
+                                 cache.key(patches[2])]))
+        cache.discard(cache.key(patches[0]))
+        self.assertEqual(cache.keys(), [cache.key(patches[2])])
+        cache.clear()
+        self.assertEqual(cache.keys(), [])
+
+    def test_broken_entry(self):
+        cache = PatchCache(join(self.tmpdir, 'cache'))
+        data = b"--- a\n+++ a\n@@ -1 +1 @@\n-a\n+b\n"
+        fromstring(data, cache=cache)
+        with open(cache._path(cache.key(data)), 'wb') as f:
+            f.write(b"broken")
+        self.assertIsNone(cache.get(cache.key(data)))
+        self.assertEqual(cache.keys(), [])
+        self.assertEqual(len(fromstring(data, cache=cache)), 1)
+
+    def test_damaged_entry(self):
+        cache = PatchCache(join(self.tmpdir, 'cache'))
+        data = b"--- a\n+++ a\n@@ -1 +1 @@\n-a\n+b\n"
+        fromstring(data, cache=cache)
+        path = cache._path(cache.key(data))
+        with open(path, 'rb') as f:
+            entry = bytearray(f.read())
+        # hunk line in data section
+        entry[-2] ^= 1
+        with open(path, 'wb') as f:
+            f.write(entry)
+        self.assertIsNone(cache.get(cache.key(data)))
+        self.assertEqual(cache.keys(), [])
+        with open(path, 'wb') as f:
+            f.write(entry)
+        with mock.patch.object(PatchSet, 'load', side_effect=TypeError):
+            self.assertIsNone(cache.get(cache.key(data)))
+        self.assertEqual(cache.keys(), [])
@@ -1,14 +1,19 @@
+import asyncio
+import mmap
+import os
+import pickle
+import shutil
 import unittest
-from os.path import join, dirname, abspath
+from copy import deepcopy
+from io import BytesIO
+from os.path import join
+from tempfile import mkdtemp
 
 from filepatch import fromstring, fromfile, PatchSet
-
-TESTS = dirname(abspath(__file__))
-TESTDATA = join(TESTS, 'data')
-
-
-def testfile(name):
-    return join(TESTDATA, name)
+from filepatch.hunk import HunkText, LazyText
+from filepatch.patchset import PatchSetTypes
+from filepatch.serialize import HEADER
+from tests.common import TESTS, FIXTURES, testfile, parsed, comparable
 
 
 class TestPatchParse(unittest.TestCase):
@@ -25,6 +30,116 @@ class TestPatchParse(unittest.TestCase):
         ps2 = fromfile(testfile("failing/not-a-patch.log"))
         self.assertFalse(ps2)
 
+    def test_fromfile_mapped(self):
+        pst = fromfile(join(TESTS, "01uni_multi/01uni_multi.patch"))
+        psm = fromfile(join(TESTS, "01uni_multi/01uni_multi.patch"),
+                       mapped=True)
+        self.assertEqual(len(psm), 5)
+        for p, pm in zip(pst, psm):
+            for h, hm in zip(p.hunks, pm.hunks):
+                self.assertIsInstance(hm.text, HunkText)
+                self.assertEqual(list(hm.text), h.text)
+                self.assertEqual(hm.text[-1], h.text[-1])
+        self.assertEqual(psm.diffstat(), pst.diffstat())
+        self.assertFalse(fromfile(testfile("failing/not-a-patch.log"),
+                                  mapped=True))
+
+    def test_dump_load(self):
+        tmpdir = mkdtemp(prefix=self.__class__.__name__)
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for name in FIXTURES:
+            pst, res = parsed(name)
+            out = BytesIO()
+            pst.dump(out)
+            with open(join(tmpdir, "dump"), "wb") as fp:
+                fp.write(b"prefix")
+                pst.dump(fp)
+            with open(join(tmpdir, "dump"), "rb") as fp:
+                fp.seek(6)
+                mapped = PatchSet.load(fp)
+            for loaded in [PatchSet.load(BytesIO(out.getvalue())), mapped]:
+                self.assertEqual(comparable(loaded), comparable(pst))
+                self.assertEqual(loaded.diffstat(), pst.diffstat())
+        self.assertRaises(ValueError, PatchSet.load, BytesIO(b"patch"))
+
+    def test_load_damaged(self):
+        pto = fromfile(join(TESTS, "01uni_multi/01uni_multi.patch"))
+        out = BytesIO()
+        pto.dump(out)
+        dump = out.getvalue()
+        for size in range(0, len(dump), 7):
+            self.assertRaises(ValueError, PatchSet.load,
+                              BytesIO(dump[:size]))
+        # hunk lines are checked only when asked for
+        dataoff = HEADER.unpack_from(dump)[12]
+        for pos in range(8, len(dump), 5):
+            damaged = bytearray(dump)
+            damaged[pos] ^= 0x10
+            self.assertRaises(ValueError, PatchSet.load,
+                              BytesIO(bytes(damaged)), verify=True)
+            if pos < dataoff:
+                self.assertRaises(ValueError, PatchSet.load,
+                                  BytesIO(bytes(damaged)))
+            else:
+                PatchSet.load(BytesIO(bytes(damaged)))
+
+    def test_hunk_text(self):
+        pto = fromfile(join(TESTS,
+                            "data/autofix/stripped-trailing-whitespace.diff"))
+        hunk = pto.items[0].hunks[0]
+        self.assertFalse(hasattr(hunk, '__dict__'))
+        self.assertIsInstance(hunk.text, HunkText)
+        self.assertEqual(len(hunk.text), len(hunk.text.ops))
+        self.assertEqual(hunk.text[:3], [b' }\n', b' \n', b' static int\n'])
+        self.assertEqual(pickle.loads(pickle.dumps(hunk.text)), hunk.text)
+
+    def test_hunk_lines(self):
+        pto = fromstring(b"--- a.txt\n+++ a.txt\n"
+                         b"@@ -1,3 +1,3 @@\n a\r\n-b\n+B\n c\n"
+                         b"\\ No newline at end of file\n")
+        hunk = pto.items[0].hunks[0]
+        self.assertEqual(hunk.source_lines, (b'a', b'b', b'c'))
+        self.assertEqual(hunk.target_lines, (b'a', b'B', b'c'))
+        self.assertIs(hunk.source_lines, hunk.source_lines)
+        self.assertEqual(hunk.source_hash, hash((b'a', b'b', b'c')))
+        # cache is reset when text is replaced
+        hunk.text = HunkText([b'-a\n', b'+A\n'])
+        self.assertEqual(hunk.source_lines, (b'a',))
+        self.assertEqual(hunk.target_hash, hash((b'A',)))
+
+    def test_iterparse(self):
+        pto = PatchSet()
+        with open(testfile("git-changed-2-files.diff"), "rb") as fp:
+            parsed = pto.iterparse(fp)
+            first = next(parsed)
+            self.assertEqual(first.source, b"jsonpickle/__init__.py")
+            self.assertEqual(first.type, PatchSetTypes.GIT)
+            self.assertEqual(len(list(parsed)), 1)
+        self.assertEqual(pto.items, [])
+        self.assertEqual(pto.errors, 0)
+        self.assertEqual(pto.type, PatchSetTypes.GIT)
+
+    def test_aiterparse(self):
+        async def chunks(data, size):
+            for i in range(0, len(data), size):
+                yield data[i:i+size]
+
+        for name in FIXTURES + ["data/failing/not-a-patch.log"]:
+            with open(join(TESTS, name), "rb") as fp:
+                data = fp.read()
+            pst, res = parsed(name)
+            for size in [1, 7, len(data)]:
+                psa = PatchSet()
+                self.assertEqual(
+                    asyncio.run(psa.aparse(chunks(data, size))), res)
+                self.assertEqual(comparable(psa), comparable(pst))
+
+    def test_iterparse_errors(self):
+        pto = PatchSet()
+        with open(testfile("failing/missing-hunk-line.diff"), "rb") as fp:
+            self.assertEqual(len(list(pto.iterparse(fp))), 2)
+        self.assertNotEqual(pto.errors, 0)
+
     def test_no_header_for_plain_diff_with_single_file(self):
         pto = fromfile(join(TESTS, "03trail_fname.patch"))
         self.assertEqual(pto.items[0].header, [])
@@ -39,6 +154,21 @@ class TestPatchParse(unittest.TestCase):
         self.assertEqual(pto.items[0].hunks[0].desc,
                          b'class JSONPluginMgr(object):')
 
+    def test_hunk_line_ends(self):
+        pto = fromfile(join(TESTS, "01uni_multi/01uni_multi.patch"))
+        self.assertEqual(pto.items[0].hunkends, dict(lf=44, crlf=0, cr=0))
+        self.assertEqual(pto.items[2].hunkends, dict(lf=0, crlf=26, cr=0))
+        self.assertEqual([len(h.text) for h in pto.items[0].hunks],
+                         [14, 20, 10])
+
+    def test_hunk_line_ends_incomplete(self):
+        # stream ends after a blank line fixed up in the last hunk
+        for text in [b" a\r\n\r\n", b" a\r\n b\r\n"]:
+            pto = PatchSet()
+            pto.parse(BytesIO(b"--- a\n+++ a\n@@ -1,4 +1,4 @@\n" + text))
+            self.assertEqual(pto.items[0].hunkends,
+                             dict(lf=0, crlf=2, cr=0))
+
     def test_autofixed_absolute_path(self):
         pto = fromfile(join(TESTS, "data/autofix/absolute-path.diff"))
         self.assertEqual(pto.errors, 0)
@@ -59,6 +189,7 @@ class TestPatchParse(unittest.TestCase):
                             "data/autofix/stripped-trailing-whitespace.diff"))
         self.assertEqual(pto.errors, 0)
         self.assertEqual(pto.warnings, 4)
+        self.assertEqual(pto.items[0].hunks[0].text[1], b' \n')
 
     def test_fail_missing_hunk_line(self):
         fp = open(join(TESTS, "data/failing/missing-hunk-line.diff"), 'rb')
@@ -66,6 +197,22 @@ class TestPatchParse(unittest.TestCase):
         self.assertNotEqual(pto.parse(fp), True)
         fp.close()
 
+    def test_fail_extra_hunk_lines(self):
+        pto = PatchSet()
+        self.assertFalse(pto.parse([b"--- a\n", b"+++ b\n",
+                                    b"@@ -1,1 +1,2 @@\n", b"-a\n", b"-b\n",
+                                    b"+c\n"]))
+        self.assertEqual(pto.errors, 1)
+        self.assertTrue(pto.items[0].hunks[0].invalid)
+
+    def test_hunk_ending_with_added_lines(self):
+        pto = fromstring(b"--- a\n+++ b\n@@ -1,1 +1,3 @@\n a\n+b\n+c\n"
+                         b"@@ -5 +7 @@\n-d\n+e\n")
+        self.assertEqual(pto.errors, 0)
+        hunks = pto.items[0].hunks
+        self.assertEqual(hunks[0].text, [b" a\n", b"+b\n", b"+c\n"])
+        self.assertEqual(hunks[1].text, [b"-d\n", b"+e\n"])
+
     def test_fail_context_format(self):
         fp = open(join(TESTS, "data/failing/context-format.diff"), 'rb')
         res = PatchSet().parse(fp)
@@ -88,3 +235,123 @@ class TestPatchParse(unittest.TestCase):
  5 files changed, 48 insertions(+), 18 deletions(-), +1203 bytes"""
         pto = fromfile(join(TESTS, "01uni_multi/01uni_multi.patch"))
         self.assertEqual(pto.diffstat(), output, "Output doesn't match")
+
+    def test_diffstat_statsonly(self):
+        for name in FIXTURES:
+            pst, res = parsed(name)
+            pss, ress = parsed(name, statsonly=True)
+            self.assertEqual(ress, res)
+            self.assertEqual(pss.diffstat(), pst.diffstat())
+            self.assertEqual(comparable(pss, hunks=False),
+                             comparable(pst, hunks=False))
+            self.assertTrue(all(p.hunks == [] for p in pss))
+        pto = fromfile(join(TESTS, "01uni_multi/01uni_multi.patch"),
+                       statsonly=True)
+        self.assertEqual((pto.items[1].inserts, pto.items[1].deletes,
+                          pto.items[1].delta), (1, 0, 54))
+
+    def test_path_lookup(self):
+        pto = fromfile(testfile("git-changed-2-files.diff"))
+        first, second = pto.items
+        self.assertIs(pto[b"jsonpickle/__init__.py"], first)
+        self.assertIs(pto["./tests//jsonpickle_test.py"], second)
+        self.assertIn("tests/jsonpickle_test.py", pto)
+        self.assertIn(first, pto)
+        self.assertNotIn("a/tests/jsonpickle_test.py", pto)
+        self.assertIsNone(pto.get("missing"))
+        with self.assertRaises(KeyError):
+            pto["missing"]
+        # renamed patches and changed items are found
+        second.target = b"tests/renamed.py"
+        self.assertIs(pto.get("tests/renamed.py"), second)
+        self.assertIs(pto.get("tests/jsonpickle_test.py"), second)
+        del pto.items[0]
+        self.assertNotIn("jsonpickle/__init__.py", pto)
+        pto.parse(BytesIO(b"--- a\n+++ b\n@@ -1 +1 @@\n-a\n+b\n"))
+        self.assertIs(pto["b"], pto.items[-1])
+        # target names are not used by can_patch()
+        self.assertIsNone(pto.can_patch("b"))
+        # parsing other patch sets doesn't invalidate the index
+        index = pto._index()
+        fromstring(b"--- c\n+++ c\n@@ -1 +1 @@\n-a\n+b\n")
+        self.assertIs(pto._index(), index)
+        # copies track renames of their own patches
+        copy = pickle.loads(pickle.dumps(pto))
+        copy.items[-1].target = b"c"
+        self.assertIs(copy["c"], copy.items[-1])
+        self.assertNotIn("c", pto)
+        # patches shared with other sets report renames to all of them
+        sub = PatchSet()
+        sub.items = list(pto.items)
+        self.assertIs(sub["b"], sub.items[-1])
+        pto.items[-1].target = b"d"
+        self.assertIs(pto.get("d"), pto.items[-1])
+        self.assertIs(sub.get("d"), pto.items[-1])
+        self.assertNotIn("b", pto)
+        self.assertNotIn("b", sub)
+        # the current directory matters for absolute source paths only
+        index = pto._index()
+        cwd = os.getcwd()
+        try:
+            os.chdir(TESTS)
+            self.assertIs(pto._index(), index)
+        finally:
+            os.chdir(cwd)
+
+    def test_fromfile_lazy(self):
+        for name in FIXTURES:
+            pst, res = parsed(name)
+            psl = fromfile(join(TESTS, name), lazy=True)
+            self.assertEqual(psl is not False, res)
+            if not res:
+                continue
+            self.assertTrue(all(p.inserts is None for p in psl))
+            # hunks with empty lines are read by the parser
+            lazy = [type(h._text) is LazyText for p in psl for h in p.hunks]
+            self.assertTrue(any(lazy))
+            self.assertEqual(all(lazy), "whitespace" not in name)
+            self.assertEqual(comparable(psl, stats=False),
+                             comparable(pst, stats=False))
+            self.assertEqual(psl.diffstat(), pst.diffstat())
+            # copies of hunks, which are not loaded yet
+            psl = fromfile(join(TESTS, name), lazy=True)
+            for copied in [pickle.loads(pickle.dumps(psl)), deepcopy(psl)]:
+                self.assertEqual(comparable(copied, stats=False),
+                                 comparable(pst, stats=False))
+
+    def test_fromfile_lazy_errors(self):
+        tmpdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        patchfile = join(tmpdir, "empty-hunk.diff")
+        with open(patchfile, "wb") as fp:
+            fp.write(b"--- a\n+++ a\n@@ -0,0 +0,0 @@\n a\n")
+        pst = fromfile(patchfile)
+        self.assertFalse(pst)
+        psl = PatchSet()
+        with open(patchfile, "rb") as fp:
+            self.assertFalse(psl.parse(mmap.mmap(fp.fileno(), 0,
+                                                 access=mmap.ACCESS_READ),
+                                       lazy=True))
+        psf = PatchSet()
+        with open(patchfile, "rb") as fp:
+            psf.parse(fp)
+        self.assertEqual((psl.errors, psl.warnings),
+                         (psf.errors, psf.warnings))
+        self.assertTrue(psl.items[0].hunks[0].invalid)
+
+    def test_diffstat_data(self):
+        pto = fromfile(join(TESTS, "01uni_multi/01uni_multi.patch"))
+        data = pto.diffstat_data()
+        self.assertEqual(data[1], (b'updatedlg.h', 1, 0, 54))
+        self.assertEqual(sum(i for name, i, d, delta in data), 48)
+        self.assertEqual(sum(d for name, i, d, delta in data), 18)
+        self.assertEqual(sum(delta for name, i, d, delta in data), 1203)
+        self.assertEqual(pto.diffstat_data(reverse=True)[1],
+                         (b'updatedlg.h', 0, 1, -54))
+        self.assertTrue(pto.diffstat(reverse=True).endswith(
+            " 5 files changed, 18 insertions(+), 48 deletions(-), "
+            "-1203 bytes"))
+        # counted from hunks if counters are not known
+        for p in pto:
+            p.inserts = p.deletes = p.delta = None
+        self.assertEqual(pto.diffstat_data(), data)